@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+#
+# async_crawler.py
+#
+# Explores a target with several pages at once. One chromium instance drives a
+# pool of isolated browser contexts, each with its own page, CDP session and
+# element buffer, and an asyncio task per page runs the crawl -> GPT -> act loop
+# so one page's LLM call overlaps with the others' browsing.
+#
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import openai
+from playwright.async_api import Error, async_playwright
+
+from commands import (
+    Click,
+    ReturnDomain,
+    Scroll,
+    Type,
+    batch_commands,
+    changes_page,
+    parse_commands,
+    rank_commands,
+)
+from llm_cache import CompletionCache, acomplete, default_cache
+from phreakbot import (
+    click_element_js,
+    completion_request,
+    fill_element_js,
+    scroll_js,
+)
+from sitemap import ExplorationGraph
+from snapshot import (
+    build_element_table,
+    dom_settled_js,
+    dom_watcher_js,
+    parse_viewport,
+    render_elements,
+    viewport_state_js,
+)
+
+
+class AsyncCrawler:
+    def __init__(self, page, wait_timeout=10000, quiet_ms=250):
+        self.page = page
+        self.wait_timeout = wait_timeout
+        self.quiet_ms = quiet_ms
+        self.client = None
+        self.page_element_buffer = {}
+        self.element_table = None
+        self.dom_version = None
+
+    @classmethod
+    async def create(cls, browser, **kwargs):
+        context = await browser.new_context(viewport={"width": 1280, "height": 1080})
+        page = await context.new_page()
+        await page.add_init_script(dom_watcher_js)
+        return cls(page, **kwargs)
+
+    async def close(self):
+        await self.page.context.close()
+
+    async def go_to_page(self, url):
+        await self.page.goto(url=url if "://" in url else "http://" + url)
+        self.client = await self.page.context.new_cdp_session(self.page)
+        self.page_element_buffer = {}
+        self.element_table = None
+        self.dom_version = None
+
+    async def scroll(self, direction, pages=1):
+        if direction == "up":
+            await self.page.evaluate(scroll_js, -pages)
+        elif direction == "down":
+            await self.page.evaluate(scroll_js, pages)
+
+    async def call_on_element(self, id, js, *args):
+        # Crawler.call_on_element
+        element = self.page_element_buffer.get(int(id)) if str(id).isdigit() else None
+        if not element:
+            print("Could not find element")
+            return None
+        try:
+            node = await self.client.send(
+                "DOM.resolveNode", {"backendNodeId": element["backend_node_id"]}
+            )
+            result = await self.client.send(
+                "Runtime.callFunctionOn",
+                {
+                    "functionDeclaration": js,
+                    "objectId": node["object"]["objectId"],
+                    "arguments": [{"value": arg} for arg in args],
+                    "returnByValue": True,
+                },
+            )
+        except Error as e:
+            print("Could not find element: {}".format(e.message))
+            return None
+        if "exceptionDetails" in result:
+            print(
+                "Could not act on element: {}".format(
+                    result["exceptionDetails"]["text"]
+                )
+            )
+            return None
+        return result["result"].get("value", True)
+
+    async def click(self, id):
+        await self.call_on_element(id, click_element_js)
+
+    async def type(self, id, text, submit=False):
+        filled = await self.call_on_element(id, fill_element_js, text)
+        if filled is False:
+            await self.page.keyboard.insert_text(text)
+        if filled is not None and submit:
+            await self.enter()
+
+    async def enter(self):
+        await self.page.keyboard.press("Enter")
+
+    def page_state(self):
+        if self.dom_version is None:
+            return None  # no mutation counter, so no way to tell
+        return (self.page.url, self.dom_version, self.viewport["top"])
+
+    async def wait_until_ready(self):
+        start = time.time()
+        deadline = start + self.wait_timeout / 1000
+
+        def remaining():
+            return max((deadline - time.time()) * 1000, 1)
+
+        try:
+            await self.page.wait_for_load_state("load", timeout=remaining())
+            await self.page.wait_for_load_state("networkidle", timeout=remaining())
+        except Error:
+            pass
+
+        try:
+            await self.page.evaluate(dom_settled_js, [self.quiet_ms, remaining()])
+        except Error:
+            try:
+                await self.page.wait_for_load_state("load", timeout=remaining())
+            except Error:
+                pass
+
+        return time.time() - start
+
+    async def get_viewport(self):
+        return parse_viewport(await self.page.evaluate(viewport_state_js))
+
+    async def crawl(self):
+        viewport = await self.get_viewport()
+        self.viewport = viewport
+
+        dom_version = viewport["dom_version"]
+        if (
+            self.element_table is None
+            or dom_version is None
+            or dom_version != self.dom_version
+        ):
+            tree = await self.client.send(
+                "DOMSnapshot.captureSnapshot",
+                {
+                    "computedStyles": [],
+                    "includeDOMRects": True,
+                    "includePaintOrder": True,
+                },
+            )
+            self.element_table = build_element_table(
+                tree, viewport["device_pixel_ratio"]
+            )
+            self.dom_version = dom_version
+
+        elements_of_interest, self.page_element_buffer = render_elements(
+            self.element_table,
+            (viewport["left"], viewport["top"], viewport["right"], viewport["bottom"]),
+        )
+        return elements_of_interest
+
+
+class CrawlerPool:
+    """
+    One browser with size isolated contexts. Use as an async context manager:
+
+        async with CrawlerPool(4) as pool:
+            await asyncio.gather(*(explore(c, ...) for c in pool.crawlers))
+    """
+
+    def __init__(
+        self, size, proxy="http://localhost:8181", headless=True, wait_timeout=10000
+    ):
+        self.size = size
+        self.proxy = proxy
+        self.headless = headless
+        self.wait_timeout = wait_timeout
+        self.crawlers = []
+
+    async def __aenter__(self):
+        self.playwright = await async_playwright().start()
+        self.browser = await self.playwright.chromium.launch(
+            proxy={"server": self.proxy, "username": "", "password": ""},
+            headless=self.headless,
+        )
+        self.crawlers = await asyncio.gather(
+            *(
+                AsyncCrawler.create(self.browser, wait_timeout=self.wait_timeout)
+                for _ in range(self.size)
+            )
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.gather(*(crawler.close() for crawler in self.crawlers))
+        await self.browser.close()
+        await self.playwright.stop()
+
+
+async def get_gpt_commands(
+    url,
+    previous_command,
+    elements,
+    n=3,
+    best_of=None,
+    cache=default_cache,
+    domain="http://localhost",
+    credentials="admin:password",
+    unvisited="",
+    sample=None,
+):
+    # sample is the llm_cache sample label, see explore
+    request = completion_request(
+        url,
+        previous_command,
+        elements,
+        n,
+        best_of,
+        domain=domain,
+        credentials=credentials,
+        unvisited=unvisited,
+    )
+    return await acomplete(request, cache, sample)
+
+
+async def run_commands(crawler, commands, domain):
+    # phreakbot.run_commands for an AsyncCrawler, returns the seconds spent waiting
+    waited = 0
+    settled = True
+    for command in batch_commands(commands):
+        if isinstance(command, Scroll):
+            await crawler.scroll(command.direction, command.pages)
+        elif isinstance(command, Click):
+            await crawler.click(command.id)
+        elif isinstance(command, Type):
+            await crawler.type(command.id, command.text, command.submit)
+        elif isinstance(command, ReturnDomain):
+            await crawler.go_to_page(domain)
+        settled = changes_page(command)
+        if settled:
+            waited += await crawler.wait_until_ready()
+    if not settled:
+        waited += await crawler.wait_until_ready()
+    return waited
+
+
+async def explore(
+    crawler,
+    name,
+    domain,
+    urls,
+    steps,
+    n=3,
+    best_of=None,
+    cache=default_cache,
+    credentials="admin:password",
+    graph=None,
+):
+    """
+    Take start urls off the shared queue and let GPT drive crawler from each
+    one for up to steps commands. graph is the ExplorationGraph all pages share.
+    """
+    graph = graph or ExplorationGraph()
+    while True:
+        try:
+            url = urls.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        try:
+            await crawler.go_to_page(url)
+        except Error as e:
+            print(f"[{name}] error loading {url}: {e}")
+            continue
+        gpt_cmd = ""
+        spare_cmds = []
+        last_state = None
+        node = None
+        retries = 0
+        for step in range(steps):
+            try:
+                elements = await crawler.crawl()
+            except Error as e:
+                print(f"[{name}] error reading {crawler.page.url}: {e}")
+                continue
+            state = crawler.page_state()
+            node = graph.observe(crawler.page.url, elements, node, gpt_cmd)
+            if graph.exhausted(node):
+                # another page or an earlier step already tried everything here
+                frontier = graph.frontier(exclude=node[0])
+                if frontier:
+                    print(f"[{name}] already explored, going to {frontier}")
+                    gpt_cmd = ""
+                    try:
+                        await crawler.go_to_page(frontier)
+                        await crawler.wait_until_ready()
+                    except Error as e:
+                        print(f"[{name}] error loading {frontier}: {e}")
+                    continue
+            prev_cmd = gpt_cmd
+            if state and state == last_state and spare_cmds:
+                gpt_cmd = spare_cmds.pop(0)
+            else:
+                try:
+                    candidates = await get_gpt_commands(
+                        crawler.page.url,
+                        prev_cmd,
+                        elements,
+                        n,
+                        best_of,
+                        cache,
+                        domain,
+                        credentials,
+                        graph.unvisited(node, elements),
+                        # a page of its own and a fresh sample after a step
+                        # that got nothing usable, not the cached rejects again
+                        sample=[name, retries],
+                    )
+                except openai.error.OpenAIError as e:
+                    print(f"[{name}] GPT error: {e}")
+                    break
+                gpt_cmds, rejected = rank_commands(
+                    candidates, crawler.page_element_buffer
+                )
+                for cmd, problems in rejected:
+                    print(f"[{name}] rejected {cmd!r}: {'; '.join(problems)}")
+                if not gpt_cmds:
+                    retries += 1
+                    continue
+                retries = 0
+                gpt_cmds = graph.prefer_unexplored(gpt_cmds, node, elements)
+                gpt_cmd = gpt_cmds[0]
+                spare_cmds = gpt_cmds[1:]
+            last_state = state
+
+            print(f"[{name}] {crawler.page.url} step {step}: {gpt_cmd!r}")
+            graph.record(node, gpt_cmd, elements)
+            try:
+                commands, _ = parse_commands(gpt_cmd)
+                waited = await run_commands(crawler, commands, domain)
+                print("[{}] wait time: {:0.2f} seconds".format(name, waited))
+            except Exception as e:
+                # a bad command or a dead page should not take the other pages down
+                print(f"[{name}] error running {gpt_cmd!r}: {e}")
+
+
+async def run_pool(
+    domain,
+    urls,
+    pages,
+    steps,
+    proxy,
+    headless,
+    wait_timeout,
+    n=3,
+    best_of=None,
+    cache=default_cache,
+    credentials="admin:password",
+):
+    # with fewer start urls than pages, several pages set off from the same url;
+    # each page samples at temperature 1.0 under its own cache label, which
+    # sends them different ways
+    urls = urls or [domain]
+    queue = asyncio.Queue()
+    for i in range(max(len(urls), pages)):
+        queue.put_nowait(urls[i % len(urls)])
+
+    graph = ExplorationGraph()
+    start = time.time()
+    async with CrawlerPool(
+        pages, proxy=proxy, headless=headless, wait_timeout=wait_timeout
+    ) as pool:
+        results = await asyncio.gather(
+            *(
+                explore(
+                    crawler,
+                    f"page {i}",
+                    domain,
+                    queue,
+                    steps,
+                    n,
+                    best_of,
+                    cache,
+                    credentials,
+                    graph,
+                )
+                for i, crawler in enumerate(pool.crawlers)
+            ),
+            return_exceptions=True,
+        )
+        # one page failing leaves the others to finish
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"[page {i}] stopped: {result!r}")
+    print("Explored for {:0.2f} seconds".format(time.time() - start))
+    print(
+        "{pages} pages in {states} states, {unexplored} elements left untried".format(
+            **graph.summary()
+        )
+    )
+    if cache:
+        print(f"GPT cache: {cache.hits} hits, {cache.misses} misses")
+
+
+def parse_args(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Explore a target with a pool of concurrent browser pages"
+    )
+    parser.add_argument(
+        "--domain",
+        dest="domain",
+        default="http://localhost",
+        help="in-scope domain, also used for RETURN DOMAIN (default: http://localhost)",
+    )
+    parser.add_argument(
+        "--credentials",
+        dest="credentials",
+        default="admin:password",
+        help="username:password for the in-scope domain (default: admin:password)",
+    )
+    parser.add_argument(
+        "--url",
+        dest="urls",
+        action="append",
+        help="start url, may be repeated (default: the domain)",
+    )
+    parser.add_argument(
+        "--pages",
+        dest="pages",
+        type=int,
+        default=4,
+        help="number of concurrent pages (default: 4)",
+    )
+    parser.add_argument(
+        "--steps",
+        dest="steps",
+        type=int,
+        default=10,
+        help="commands to run from each start url (default: 10)",
+    )
+    parser.add_argument(
+        "--proxy",
+        dest="proxy",
+        default="http://localhost:8181",
+        help="proxy for the browser (default: http://localhost:8181)",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        dest="wait_timeout",
+        type=int,
+        default=10000,
+        help="ms to wait for the page to settle after each command (default: 10000)",
+    )
+    parser.add_argument(
+        "--candidates",
+        dest="n",
+        type=int,
+        default=3,
+        help="completions to request per step, spares are tried when a command does nothing (default: 3)",
+    )
+    parser.add_argument(
+        "--best-of",
+        dest="best_of",
+        type=int,
+        default=None,
+        help="completions generated server side to pick the candidates from (default: --candidates)",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=".phreakbot_cache.sqlite",
+        help="sqlite file to cache GPT completions in (default: .phreakbot_cache.sqlite)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_const",
+        const=None,
+        help="always ask the API",
+    )
+    parser.add_argument(
+        "--headed",
+        dest="headless",
+        action="store_false",
+        help="show the browser windows",
+    )
+    args = parser.parse_args(argv)
+    return args
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    asyncio.run(
+        run_pool(
+            args.domain,
+            args.urls,
+            args.pages,
+            args.steps,
+            args.proxy,
+            args.headless,
+            args.wait_timeout,
+            args.n,
+            args.best_of,
+            CompletionCache(args.cache) if args.cache else None,
+            args.credentials,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
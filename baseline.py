@@ -0,0 +1,146 @@
+#
+# baseline.py
+#
+# What a (route, parameter) normally answers with, kept as fingerprints rather
+# than bodies: status, length, a simhash of the tokens, hashes of every line
+# and the response times. Fuzz results are scored against the fingerprints of
+# a few unfuzzed requests, so pages that differ a little on every load (csrf
+# tokens, timestamps) don't count as anomalies.
+#
+
+import hashlib
+import re
+import statistics
+from collections import Counter
+from functools import lru_cache
+
+token_re = re.compile(r"\w+|[^\w\s]")
+
+
+def stable_hash(text):
+    return int.from_bytes(
+        hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+@lru_cache(maxsize=65536)
+def token_lanes(token):
+    # the token's hash with every bit spread into its own 32 bit lane, so the
+    # per bit counts of a whole page add up in one big integer sum
+    h = stable_hash(token)
+    return sum(1 << 32 * bit for bit in range(64) if h >> bit & 1)
+
+
+def simhash(text):
+    counts = Counter(token_re.findall(text))
+    total = sum(counts.values())
+    lanes = sum(token_lanes(token) * count for token, count in counts.items())
+    return sum(
+        1 << bit for bit in range(64) if 2 * (lanes >> 32 * bit & 0xFFFFFFFF) > total
+    )
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def line_hash(line):
+    return stable_hash(line.strip())
+
+
+def line_hashes(text):
+    return frozenset(line_hash(line) for line in text.splitlines() if line.strip())
+
+
+class Fingerprint:
+    __slots__ = ("status", "length", "simhash", "lines", "elapsed")
+
+    def __init__(self, result):
+        body = result["body"]
+        self.status = result["status"]
+        self.length = len(body)
+        self.simhash = simhash(body)
+        self.lines = line_hashes(body)
+        self.elapsed = result["elapsed"]
+
+
+class Baseline:
+    """
+    Fingerprints of the unfuzzed responses for one (route, parameter). Add a
+    few samples, then compare fuzz results to them.
+    """
+
+    def __init__(self, slow=2.5, length_tolerance=0.1, min_content_length=512):
+        self.slow = slow
+        self.length_tolerance = length_tolerance
+        # a simhash of a handful of tokens flips bits on any change, leave
+        # small responses to the length check
+        self.min_content_length = min_content_length
+        self.samples = []
+        self.lines = set()
+        self.noise = 0
+
+    def add(self, result):
+        fingerprint = Fingerprint(result)
+        # the samples already differ from each other by this much on their own
+        for sample in self.samples:
+            self.noise = max(self.noise, hamming(sample.simhash, fingerprint.simhash))
+        self.samples.append(fingerprint)
+        self.lines |= fingerprint.lines
+
+    def knows_line(self, line):
+        return line_hash(line) in self.lines
+
+    def compare(self, result):
+        """
+        Score result against the samples. Returns (score, reasons), where score
+        is 0 for a response that looks like the baseline and grows with every
+        way it doesn't.
+        """
+        score = 0
+        reasons = []
+        body = result["body"]
+
+        if result["status"] not in {s.status for s in self.samples}:
+            score += 1
+            reasons.append("status {}".format(result["status"]))
+
+        lengths = [s.length for s in self.samples]
+        tolerance = max(64, int(max(lengths) * self.length_tolerance))
+        if not min(lengths) - tolerance <= len(body) <= max(lengths) + tolerance:
+            score += 1
+            reasons.append("length {} -> {}".format(lengths[-1], len(body)))
+
+        if min(lengths) >= self.min_content_length:
+            distance = min(hamming(simhash(body), s.simhash) for s in self.samples)
+            if distance > self.noise + 3:
+                score += distance / 64
+                reasons.append("content {}/64".format(distance))
+
+        times = [s.elapsed for s in self.samples]
+        mean = statistics.mean(times)
+        spread = statistics.pstdev(times)
+        if result["elapsed"] > mean + max(self.slow, 4 * spread):
+            score += 1
+            reasons.append("slow {:0.1f}s".format(result["elapsed"]))
+
+        return score, reasons
+
+
+class BaselineIndex:
+    def __init__(self, **kwargs):
+        # kwargs go to every Baseline
+        self.kwargs = kwargs
+        self.baselines = {}
+
+    def add(self, route, parameter, result):
+        key = (route, parameter)
+        if key not in self.baselines:
+            self.baselines[key] = Baseline(**self.kwargs)
+        self.baselines[key].add(result)
+
+    def get(self, route, parameter):
+        return self.baselines.get((route, parameter))
+
+    def compare(self, route, parameter, result):
+        return self.baselines[(route, parameter)].compare(result)
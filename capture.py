@@ -0,0 +1,132 @@
+#
+# capture.py
+#
+# Append-only log of the traffic going through proxy.py. Handler threads only
+# put finished records on a queue; a background thread serializes them to a
+# JSONL file, one exchange per line, which later stages read back as the
+# sitemap and evidence store.
+#
+
+import base64
+import hashlib
+import json
+import queue
+import threading
+import time
+
+
+def encode_body(data):
+    # bodies are stored as text when they are utf-8 and base64 otherwise
+    if data is None:
+        return None, None
+    try:
+        return data.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode("ascii"), "base64"
+
+
+def decode_body(record, prefix):
+    body = record.get(prefix + "_body")
+    if body is None:
+        return b""
+    if record.get(prefix + "_body_encoding") == "base64":
+        return base64.b64decode(body)
+    return body.encode("utf-8")
+
+
+class BodyTap:
+    """
+    Sees every piece of a streamed body go by, hashing and counting all of it
+    and keeping the first keep bytes for the capture record.
+    """
+
+    def __init__(self, keep=64 * 1024):
+        self.keep = keep
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+        self.head = bytearray()
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.length += len(data)
+        if len(self.head) < self.keep:
+            self.head += data[: self.keep - len(self.head)]
+        return data
+
+    def fields(self, prefix):
+        body, encoding = encode_body(bytes(self.head))
+        return {
+            prefix + "_body": body,
+            prefix + "_body_encoding": encoding,
+            prefix + "_body_length": self.length,
+            prefix + "_body_sha256": self.sha256.hexdigest(),
+            prefix + "_body_truncated": self.length > len(self.head),
+        }
+
+
+class TrafficCapture:
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, record):
+        # called on the request thread, never blocks it
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record) + "\n")
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def read_capture(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def follow_capture(path, poll_interval=0.5, stop=None, offset=0):
+    """
+    Yield the records of a capture file as the proxy appends them, starting
+    offset bytes in (the start of a record, 0 for the beginning). Runs until
+    stop (a threading.Event) is set.
+    """
+    while True:
+        try:
+            f = open(path, encoding="utf-8")
+            break
+        except FileNotFoundError:
+            if stop is not None and stop.is_set():
+                return
+            time.sleep(poll_interval)
+
+    with f:
+        f.seek(offset)
+        pending = ""
+        while stop is None or not stop.is_set():
+            line = f.readline()
+            if not line:
+                time.sleep(poll_interval)
+                continue
+            pending += line
+            if not pending.endswith("\n"):
+                continue  # the writer is half way through this record
+            if pending.strip():
+                yield json.loads(pending)
+            pending = ""
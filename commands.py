@@ -0,0 +1,165 @@
+#
+# commands.py
+#
+# The browser command language GPT answers in, and the checks run on every
+# suggestion before it reaches the browser. The parser is forgiving about case,
+# spacing, quotes and stray decoration ("1. click [5]", TYPE 3 'x') so a
+# slightly off completion still runs instead of costing another round trip, and
+# lines that aren't commands are reported instead of raising.
+#
+
+import re
+from collections import Counter, namedtuple
+
+Scroll = namedtuple("Scroll", ["direction", "pages"])
+Click = namedtuple("Click", ["id"])
+Type = namedtuple("Type", ["id", "text", "submit"])
+ReturnDomain = namedtuple("ReturnDomain", [])
+
+prefix_re = re.compile(r"^(?:\d+[.)]\s*|[-*>]\s*|(?:YOUR\s+)?COMMAND:\s*)+", re.I)
+element_id = r"(?:ON\s+|INTO\s+)?(?:ID\s*[=:]?\s*)?[\[(<#]?\s*(\d+)\s*[\])>]?"
+scroll_grammar_re = re.compile(r"^SCROLL[\s_-]*(UP|DOWN)\b", re.I)
+# DOMAIN is required, "Return to the form" is prose, not a command
+return_grammar_re = re.compile(r"^RETURN[\s_-]*(?:TO[\s_-]*)?DOMAIN\b", re.I)
+click_grammar_re = re.compile(r"^CLICK\s*" + element_id, re.I)
+type_grammar_re = re.compile(
+    r"^TYPE[\s_-]*(SUBMIT)?\s*" + element_id + r"\s*[,:]?\s*(.*)$", re.I | re.DOTALL
+)
+quote_pairs = {'"': '"', "'": "'", "“": "”", "‘": "’", "`": "`"}
+
+
+def unquote(text):
+    text = text.strip()
+    if len(text) >= 2 and quote_pairs.get(text[0]) == text[-1]:
+        return text[1:-1]
+    return text
+
+
+def parse_line(line):
+    # one command, or None when line isn't one
+    line = prefix_re.sub("", line.strip()).strip()
+    match = scroll_grammar_re.match(line)
+    if match:
+        return Scroll(match.group(1).lower(), 1)
+    if return_grammar_re.match(line):
+        return ReturnDomain()
+    match = click_grammar_re.match(line)
+    if match:
+        return Click(int(match.group(1)))
+    match = type_grammar_re.match(line)
+    if match and match.group(3).strip():
+        # TYPE 3 with nothing to type would clear the field, "" has to be asked for
+        submit, id, text = match.groups()
+        return Type(int(id), unquote(text), bool(submit))
+    return None
+
+
+def parse_commands(text):
+    """
+    Parse a completion into commands. Returns (commands, errors), errors being
+    (line, reason) pairs for the lines that aren't commands.
+    """
+    commands = []
+    errors = []
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        command = parse_line(line)
+        if command is None:
+            errors.append((line.strip(), "not a command"))
+        else:
+            commands.append(command)
+    return commands, errors
+
+
+def format_command(command):
+    if isinstance(command, Scroll):
+        return "\n".join(["SCROLL " + command.direction.upper()] * command.pages)
+    if isinstance(command, Click):
+        return f"CLICK {command.id}"
+    if isinstance(command, Type):
+        verb = "TYPESUBMIT" if command.submit else "TYPE"
+        return f'{verb} {command.id} "{command.text}"'
+    return "RETURN DOMAIN"
+
+
+def format_commands(commands):
+    return "\n".join(format_command(command) for command in commands)
+
+
+def batch_commands(commands):
+    # consecutive scrolls the same way become one scroll by several pages.
+    # clicks and types each stay one element call, run_commands already skips
+    # waiting for the page between the ones that can't change it
+    batched = []
+    for command in commands:
+        if (
+            isinstance(command, Scroll)
+            and batched
+            and isinstance(batched[-1], Scroll)
+            and batched[-1].direction == command.direction
+        ):
+            batched[-1] = batched[-1]._replace(pages=batched[-1].pages + 1)
+        else:
+            batched.append(command)
+    return batched
+
+
+def changes_page(command):
+    # commands after which the page may navigate or rerender
+    return isinstance(command, (Click, ReturnDomain)) or (
+        isinstance(command, Type) and command.submit
+    )
+
+
+def check_command(cmd, page_element_buffer):
+    """
+    Return a list of reasons cmd can't be run on the page described by
+    page_element_buffer, empty when it parses to commands that all target
+    elements on the page.
+    """
+    commands, _ = parse_commands(cmd)
+    if not commands:
+        return ["no command in {!r}".format(cmd)]
+
+    problems = []
+    for command in commands:
+        id = getattr(command, "id", None)
+        if id is not None and id not in page_element_buffer:
+            problems.append(f"no element with id {id}: {format_command(command)}")
+    return problems
+
+
+def rank_commands(candidates, page_element_buffer):
+    """
+    Sort the completions for one prompt into runnable commands, best first, and
+    rejected ones as (command, problems) pairs.
+
+    Candidates are rewritten in the strict form, dropping lines that aren't
+    commands, so spelling variants of the same command count as one. Commands
+    several completions agree on rank first, ties keep the order the API
+    returned them in.
+    """
+    normalized = []
+    rejected = []
+    for candidate in candidates:
+        commands, errors = parse_commands(candidate)
+        if commands:
+            rejected += [(line, [reason + ", ignored"]) for line, reason in errors]
+            normalized.append(format_commands(commands))
+        else:
+            normalized.append(candidate.strip())
+    votes = Counter(normalized)
+
+    commands = []
+    for candidate in normalized:
+        if candidate in commands or candidate in (cmd for cmd, _ in rejected):
+            continue
+        problems = check_command(candidate, page_element_buffer)
+        if problems:
+            rejected.append((candidate, problems))
+        else:
+            commands.append(candidate)
+
+    commands.sort(key=lambda cmd: -votes[cmd])
+    return commands, rejected
@@ -0,0 +1,84 @@
+#
+# compact.py
+#
+# Fits the elements Crawler.crawl renders into a token budget for the browse
+# prompt. Elements are kept whole and in page order, but when they don't all
+# fit the ones GPT can act on (inputs, buttons, links) win over plain text, and
+# entries repeated by navigation bars and footers are only shown once.
+#
+
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+element_re = re.compile(r"^<(\w+) id=(\d+)(.*?)(?:/>|>(.*)</\1>)$", re.DOTALL)
+
+element_scores = {
+    "input": 5,
+    "textarea": 5,
+    "button": 4,
+    "link": 3,
+    "text": 1,
+    "img": 0,
+}
+
+# only repeats of these are dropped
+dedupe_tags = set(["link", "text"])
+
+
+def estimate_tokens(text):
+    # roughly four characters per token for the english and markup we send
+    return len(text) // 4 + 1
+
+
+def shorten_text(element, max_text):
+    match = element_re.match(element)
+    if not match or match.group(4) is None or len(match.group(4)) <= max_text:
+        return element
+    tag, id, meta, text = match.groups()
+    return f"<{tag} id={id}{meta}>{text[:max_text].rstrip()}...</{tag}>"
+
+
+def compact_elements(elements, budget=1200, max_text=200):
+    """
+    Join the elements from Crawler.crawl into the browser content for the
+    prompt, keeping as many of the most useful ones as fit in budget tokens.
+    """
+    candidates = []
+    seen = set()
+    for position, element in enumerate(elements):
+        element = shorten_text(element, max_text)
+        match = element_re.match(element)
+        tag = match.group(1) if match else "text"
+
+        # the same "Home" link in the header, sidebar and footer only costs tokens
+        # once. Inputs and buttons that look alike are different fields of a form
+        if tag in dedupe_tags:
+            key = (tag, match.group(3), match.group(4)) if match else element
+            if key in seen:
+                continue
+            seen.add(key)
+
+        candidates.append((-element_scores.get(tag, 1), position, element))
+
+    kept = []
+    used = 0
+    for _, position, element in sorted(candidates):
+        cost = estimate_tokens(element) + 1
+        if used + cost > budget:
+            continue
+        kept.append((position, element))
+        used += cost
+
+    return "\n".join(element for _, element in sorted(kept))
+
+
+def compact_url(url, max_value=40):
+    # drop the fragment and trim long query values (tokens, tracking ids), keep every key
+    parts = urlsplit(url)
+    query = [
+        (key, value if len(value) <= max_value else value[:max_value] + "...")
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+    ]
+    return urlunsplit(
+        (parts.scheme, parts.netloc, parts.path, urlencode(query, safe="./"), "")
+    )
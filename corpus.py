@@ -0,0 +1,134 @@
+#
+# corpus.py
+#
+# Payloads GPT has come up with, kept per attack type across routes and runs.
+# SQL injection and XSS payloads work about as well on one parameter as on the
+# next, so the fuzzer starts from the corpus's best payloads straight away and
+# new completions only add to it. Payloads are ranked by how often they have
+# led to a finding and deduplicated on a normalized form that only evens out
+# what the target can't tell apart: runs of spaces, and the case of SQL
+# keywords. Quoting, encoding (%27, &lt;), tag case (<SCRIPT>) and mixed-case
+# keywords (UnIoN) are how filters get bypassed and are kept.
+#
+
+import re
+import sqlite3
+import threading
+import time
+
+space_re = re.compile(r"\s+")
+spaces_re = re.compile(r" {2,}")
+sql_keyword_re = re.compile(
+    # not right inside quotes, 'USER'='USER' compares strings
+    r"(?<!['\"])\b(?:and|or|not|union|all|select|from|where|order|group|by|having|limit|"
+    r"null|sleep|benchmark|waitfor|delay|insert|update|delete|drop|like|"
+    r"case|when|then|else|end|if|concat|version|database|user)\b(?!['\"])",
+    re.I,
+)
+
+
+def normalize_attack(attack):
+    return space_re.sub(" ", attack.strip().lower())
+
+
+def fold_keyword(match):
+    keyword = match.group(0)
+    if keyword.isupper() or keyword.islower():
+        return keyword.lower()
+    return keyword
+
+
+def normalize_payload(payload, attack=""):
+    # ' OR 1=1 -- - and ' or  1=1 -- - are one payload, ' UnIoN SELECT and %27 OR 1=1 aren't
+    payload = spaces_re.sub(" ", payload.strip())
+    if "sql" in attack:
+        payload = sql_keyword_re.sub(fold_keyword, payload)
+    return payload
+
+
+class PayloadCorpus:
+    def __init__(self, path=".phreakbot_payloads.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS payloads ("
+                "attack TEXT, normalized TEXT, payload TEXT, source TEXT, "
+                "added REAL, uses INTEGER DEFAULT 0, hits INTEGER DEFAULT 0, "
+                "PRIMARY KEY (attack, normalized))"
+            )
+        return self.db
+
+    def add(self, attack, payloads, source="gpt"):
+        # returns the payloads that weren't in the corpus yet
+        attack = normalize_attack(attack)
+        added = []
+        with self.lock:
+            db = self.connect()
+            for payload in payloads:
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO payloads (attack, normalized, payload, "
+                    "source, added) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        attack,
+                        normalize_payload(payload, attack),
+                        payload,
+                        source,
+                        time.time(),
+                    ),
+                )
+                if cursor.rowcount:
+                    added.append(payload)
+            db.commit()
+        return added
+
+    def top(self, attack, n=50):
+        """
+        The n best payloads for attack. Payloads are ranked by their hit rate,
+        counting one miss and one hit up front so untried payloads sit between
+        ones that work and ones that keep failing.
+        """
+        with self.lock:
+            rows = (
+                self.connect()
+                .execute(
+                    "SELECT payload FROM payloads WHERE attack = ? "
+                    "ORDER BY (hits + 1.0) / (uses + 2.0) DESC, added LIMIT ?",
+                    (normalize_attack(attack), n),
+                )
+                .fetchall()
+            )
+        return [payload for payload, in rows]
+
+    def record(self, attack, used, hits=()):
+        # used is every payload sent, hits the ones that led to a finding
+        attack = normalize_attack(attack)
+        with self.lock:
+            db = self.connect()
+            db.executemany(
+                "UPDATE payloads SET uses = uses + 1 "
+                "WHERE attack = ? AND normalized = ?",
+                [(attack, normalize_payload(payload, attack)) for payload in used],
+            )
+            db.executemany(
+                "UPDATE payloads SET hits = hits + 1 "
+                "WHERE attack = ? AND normalized = ?",
+                [(attack, normalize_payload(payload, attack)) for payload in hits],
+            )
+            db.commit()
+
+    def stats(self, attack):
+        with self.lock:
+            return (
+                self.connect()
+                .execute(
+                    "SELECT COUNT(*), SUM(uses), SUM(hits) FROM payloads "
+                    "WHERE attack = ?",
+                    (normalize_attack(attack),),
+                )
+                .fetchone()
+            )
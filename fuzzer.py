@@ -1,5 +1,29 @@
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
 from langchain import PromptTemplate
 
+from baseline import BaselineIndex
+from capture import read_capture
+from corpus import PayloadCorpus
+from injection import (
+    header_value,
+    mutate_request,
+    parameter_value,
+    replayable,
+    request_from_record,
+    route_template,
+)
+from llm_cache import acomplete, complete, default_cache
+from recognize import Recognizer
+from sessions import SessionStore, parse_cookie_header
+
 fuzz_template = """
 You are a proxy fuzzing http requests for a bug bounty. You are given:
     (1) the route being fuzzed
@@ -56,3 +80,380 @@ vuln_recog_prompt = PromptTemplate(
     input_variables=["tech_stack", "parameter", "payload", "response"],
     template=vuln_recognition_template,
 )
+
+
+# completion request for fuzz_prompt, run it through llm_cache.complete so
+# repeated (route, parameter, attack) combinations skip the API
+def fuzz_request(route, parameter, value, target_attack):
+    return dict(
+        model="text-davinci-002",
+        prompt=fuzz_prompt.format(
+            route=route, parameter=parameter, value=value, target_attack=target_attack
+        ),
+        temperature=0.7,
+        max_tokens=256,
+        stop=["<END>"],
+    )
+
+
+def parse_payloads(text):
+    # the completion stops at <END>, so this is everything before it split on commas
+    payloads = []
+    for payload in text.split("<END>")[0].split(","):
+        payload = payload.strip()
+        if payload and payload not in payloads:
+            payloads.append(payload)
+    return payloads
+
+
+def get_fuzz_payloads(route, parameter, value, target_attack, cache=default_cache):
+    texts = complete(fuzz_request(route, parameter, value, target_attack), cache)
+    return parse_payloads(texts[0]) if texts else []
+
+
+async def aget_fuzz_payloads(
+    route, parameter, value, target_attack, cache=default_cache
+):
+    texts = await acomplete(fuzz_request(route, parameter, value, target_attack), cache)
+    return parse_payloads(texts[0]) if texts else []
+
+
+class TopUp(threading.Thread):
+    # asks GPT for payloads in the background and adds the new ones to the corpus
+    def __init__(self, corpus, route, parameter, value, target_attack):
+        super().__init__(daemon=True)
+        self.corpus = corpus
+        self.args = (route, parameter, value, target_attack)
+        self.added = []
+
+    def run(self):
+        payloads = get_fuzz_payloads(*self.args)
+        self.added = self.corpus.add(self.args[3], payloads)
+
+
+class RateLimiter:
+    # at most rate acquisitions per second, shared by all tasks
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class FuzzEngine:
+    """
+    Sends mutated requests concurrently with aiohttp, at most per_host at a
+    time to one host and rate requests per second overall (None for no
+    limit), retrying connection errors and timeouts.
+    """
+
+    def __init__(
+        self,
+        per_host=50,
+        rate=None,
+        retries=2,
+        timeout=10,
+        sessions=None,
+        max_body=256 * 1024,
+        verbose=True,
+    ):
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.timeout = timeout
+        # a SessionStore, its cookies replace the captured ones so payloads go out logged in
+        self.sessions = sessions
+        self.max_body = max_body
+        self.verbose = verbose
+        self.stats = {}
+
+    def prepare_headers(self, request):
+        headers = list(request["headers"])
+        if self.sessions:
+            # captured cookies, refreshed from the session store, then the payload
+            cookies = parse_cookie_header(header_value(headers, "cookie"))
+            cookies.update(
+                parse_cookie_header(self.sessions.cookie_header(request["url"]))
+            )
+            if request.get("location") == "cookie":
+                cookies[request["parameter"]] = request["payload"]
+            if cookies:
+                cookie = "; ".join("{}={}".format(k, v) for k, v in cookies.items())
+                headers = [(n, v) for n, v in headers if n.lower() != "cookie"]
+                headers.append(("Cookie", cookie))
+        return headers
+
+    async def send(self, session, limiter, slots, request):
+        result = {
+            "url": request["url"],
+            "parameter": request.get("parameter"),
+            "payload": request.get("payload"),
+        }
+        slot = slots[urlsplit(request["url"]).netloc]
+        for attempt in range(self.retries + 1):
+            # the clock and the timeout start once one of the host's per_host
+            # connections is free, time queued behind other payloads would
+            # otherwise look like a slow response
+            async with slot:
+                await limiter.acquire()
+                start = time.monotonic()
+                try:
+                    async with session.request(
+                        request["method"],
+                        request["url"],
+                        headers=self.prepare_headers(request),
+                        data=request["body"] or None,
+                        allow_redirects=False,
+                    ) as resp:
+                        body = await resp.content.read(self.max_body)
+                        result.update(
+                            status=resp.status,
+                            headers=list(resp.headers.items()),
+                            body=body.decode("utf-8", errors="replace"),
+                            elapsed=time.monotonic() - start,
+                            error=None,
+                        )
+                        return result
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    result.update(status=None, error=repr(e))
+                except ValueError as e:
+                    # aiohttp won't send it (a newline in a header payload), no point retrying
+                    result.update(status=None, error=repr(e))
+                    break
+            await asyncio.sleep(0.1 * 2**attempt)
+        return result
+
+    async def run(self, requests, on_result=None):
+        """
+        Send every request and return the results, or hand each one to
+        on_result as it arrives (and keep none) when given.
+        """
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        limiter = RateLimiter(self.rate)
+        slots = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        results = []
+        errors = 0
+
+        start = time.monotonic()
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar()
+        ) as session:
+            tasks = [
+                asyncio.ensure_future(self.send(session, limiter, slots, request))
+                for request in requests
+            ]
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                if result["error"]:
+                    errors += 1
+                if on_result:
+                    on_result(result)
+                else:
+                    results.append(result)
+        elapsed = time.monotonic() - start
+
+        self.stats = {
+            "requests": len(tasks),
+            "errors": errors,
+            "seconds": elapsed,
+            "requests_per_second": len(tasks) / elapsed if elapsed else 0,
+        }
+        if self.verbose:
+            print(
+                "Sent {requests} requests in {seconds:0.2f} seconds "
+                "({requests_per_second:0.1f}/s, {errors} errors)".format(**self.stats)
+            )
+        return results
+
+
+def parse_args(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Fuzz a parameter of captured requests with GPT generated payloads"
+    )
+    parser.add_argument(
+        "--capture",
+        dest="capture",
+        default="capture.jsonl",
+        help="traffic recorded by proxy.py (default: capture.jsonl)",
+    )
+    parser.add_argument(
+        "--route",
+        dest="route",
+        required=True,
+        help="fuzz captured requests whose url path is this route",
+    )
+    parser.add_argument(
+        "--parameter",
+        dest="parameter",
+        required=True,
+        help="parameter to fuzz, JSON fields as dotted paths with dots in keys escaped (a.b\\.c)",
+    )
+    parser.add_argument(
+        "--location",
+        dest="location",
+        choices=["query", "form", "multipart", "json", "cookie", "header", "path"],
+        help="where the parameter is, as listed by injection.py "
+        "(default: query string or form)",
+    )
+    parser.add_argument(
+        "--attack",
+        dest="attack",
+        default="sql injection",
+        help="target attack for the payloads (default: sql injection)",
+    )
+    parser.add_argument(
+        "--payloads",
+        dest="payloads",
+        help="file with one payload per line to add to the corpus instead of asking GPT",
+    )
+    parser.add_argument(
+        "--corpus",
+        dest="corpus",
+        default=".phreakbot_payloads.sqlite",
+        help="payloads kept across runs (default: .phreakbot_payloads.sqlite)",
+    )
+    parser.add_argument(
+        "--top",
+        dest="top",
+        type=int,
+        default=50,
+        help="how many of the corpus's best payloads to send (default: 50)",
+    )
+    parser.add_argument(
+        "--sessions",
+        dest="sessions",
+        default="sessions.txt",
+        help="cookie jar saved by proxy.py (default: sessions.txt)",
+    )
+    parser.add_argument("--per-host", dest="per_host", type=int, default=50)
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        type=float,
+        help="requests per second (default: no limit)",
+    )
+    parser.add_argument("--retries", dest="retries", type=int, default=2)
+    parser.add_argument(
+        "--tech-stack",
+        dest="tech_stack",
+        default="unknown",
+        help="what the target runs on, for the recognition prompt",
+    )
+    parser.add_argument(
+        "--baseline-samples",
+        dest="baseline_samples",
+        type=int,
+        default=3,
+        help="unfuzzed requests to compare results against (default: 3)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=5,
+        help="suspicious results per recognition prompt (default: 5)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    records = [
+        record
+        for record in read_capture(args.capture)
+        if args.route
+        in (
+            urlsplit(record.get("url", "")).path,
+            route_template(urlsplit(record.get("url", "")).path)[0],
+        )
+        and replayable(record)
+    ]
+    if not records:
+        sys.exit("no captured request for {}".format(args.route))
+    request = request_from_record(records[-1])
+    value = parameter_value(request, args.parameter, args.location)
+    if value is None:
+        sys.exit("{} has no parameter {}".format(args.route, args.parameter))
+
+    corpus = PayloadCorpus(args.corpus)
+    top_up = None
+    if args.payloads:
+        with open(args.payloads) as f:
+            payloads = [line.rstrip("\n") for line in f if line.strip()]
+        corpus.add(args.attack, payloads, source=args.payloads)
+    else:
+        # GPT only adds to the corpus, fuzzing starts from what is already there
+        top_up = TopUp(corpus, args.route, args.parameter, value, args.attack)
+        top_up.start()
+    payloads = corpus.top(args.attack, args.top)
+    if not payloads and top_up:
+        top_up.join()
+        payloads = top_up.added
+
+    engine = FuzzEngine(
+        per_host=args.per_host,
+        rate=args.rate,
+        retries=args.retries,
+        sessions=SessionStore(args.sessions, autosave=False),
+    )
+    # the unfuzzed request is what the detectors compare every result against
+    baselines = BaselineIndex()
+    original = mutate_request(request, args.parameter, value, args.location)
+    for result in asyncio.run(engine.run([original] * args.baseline_samples)):
+        if result["error"]:
+            sys.exit("baseline request failed: {}".format(result["error"]))
+        baselines.add(args.route, args.parameter, result)
+    baseline = baselines.get(args.route, args.parameter)
+
+    recognizer = Recognizer(args.tech_stack, batch_size=args.batch_size)
+
+    def on_result(result):
+        recognizer.observe(result, baseline)
+
+    requests = [
+        mutate_request(request, args.parameter, p, args.location) for p in payloads
+    ]
+    asyncio.run(engine.run(requests, on_result))
+    if top_up:
+        top_up.join()
+        fresh = [p for p in top_up.added if p not in payloads]
+        if fresh:
+            requests = [
+                mutate_request(request, args.parameter, p, args.location) for p in fresh
+            ]
+            asyncio.run(engine.run(requests, on_result))
+            payloads += fresh
+    print(
+        "{} of {} results tripped a detector".format(
+            len(recognizer.candidates), recognizer.checked
+        )
+    )
+    findings = recognizer.recognize()
+    corpus.record(
+        args.attack,
+        payloads,
+        [finding["payload"] for finding in findings if finding["vulnerable"]],
+    )
+    for finding in findings:
+        print(
+            "{verdict} {payload!r} ({signals}) {reason}".format(
+                verdict="VULNERABLE" if finding["vulnerable"] else "-",
+                payload=finding["payload"],
+                signals=", ".join(finding["signals"]),
+                reason=finding["reason"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
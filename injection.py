@@ -0,0 +1,400 @@
+#
+# injection.py
+#
+# Turns the requests proxy.py captures into injection points for the fuzzer:
+# every query and form parameter, JSON field, cookie, interesting header and
+# id-like path segment, each as (route, location, parameter, value) plus the
+# request to replay. Routes are templated, so /user/1 and /user/2 are one
+# route and their points are only queued once, and points are queued as the
+# capture grows so fuzzing can start while the crawler is still going.
+#
+
+import argparse
+import json
+import queue
+import re
+import sys
+import threading
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+
+from capture import decode_body, follow_capture, read_capture
+from sessions import parse_cookie_header
+
+# headers applications are known to read and echo, the rest is left alone
+fuzzable_headers = ["user-agent", "referer", "x-forwarded-for", "origin"]
+
+segment_templates = [
+    (re.compile(r"^\d+$"), "{int}"),
+    (
+        re.compile(
+            r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.I
+        ),
+        "{uuid}",
+    ),
+    (re.compile(r"^[0-9a-f]{16,}$", re.I), "{hex}"),
+]
+
+boundary_re = re.compile(r'boundary="?([^";]+)"?', re.I)
+part_name_re = re.compile(rb'name="([^"]*)"', re.I)
+
+
+def route_template(path):
+    """
+    The path with id-like segments replaced by placeholders, and the
+    (index, value) of every replaced segment.
+    """
+    segments = path.split("/")
+    templated = []
+    for index, segment in enumerate(segments):
+        for pattern, placeholder in segment_templates:
+            if pattern.match(segment):
+                segments[index] = placeholder
+                templated.append((index, segment))
+                break
+    return "/".join(segments), templated
+
+
+def replayable(record):
+    # a request the capture kept whole, bodies cut at the capture limit can't be sent again
+    return bool(
+        record.get("url")
+        and not record.get("error")
+        and record["method"] != "CONNECT"
+        and not record.get("request_body_truncated")
+    )
+
+
+def request_from_record(record):
+    # the parts of a capture record needed to send it again
+    return {
+        "method": record["method"],
+        "url": record["url"],
+        "headers": [
+            (name, value)
+            for name, value in record["request_headers"]
+            if name.lower() not in ("content-length", "transfer-encoding", "host")
+        ],
+        "body": decode_body(record, "request"),
+    }
+
+
+def header_value(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def replace_header(headers, name, value):
+    # keeps the captured spelling of the header name when there is one
+    for key, _ in headers:
+        if key.lower() == name.lower():
+            name = key
+    headers = [(k, v) for k, v in headers if k.lower() != name.lower()]
+    return headers + [(name, value)]
+
+
+def json_path(keys):
+    # keys joined with dots, dots and backslashes in a key are escaped with a backslash
+    return ".".join(str(key).replace("\\", "\\\\").replace(".", "\\.") for key in keys)
+
+
+def split_json_path(path):
+    keys = [""]
+    escaped = False
+    for char in path:
+        if escaped:
+            keys[-1] += char
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == ".":
+            keys.append("")
+        else:
+            keys[-1] += char
+    return keys
+
+
+def json_fields(value, keys=()):
+    # the leaves of a JSON document as (json_path, value)
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        yield json_path(keys), value
+        return
+    for key, item in items:
+        yield from json_fields(item, keys + (key,))
+
+
+def set_json_field(value, path, payload):
+    keys = split_json_path(path)
+    target = value
+    for key in keys[:-1]:
+        target = target[int(key) if isinstance(target, list) else key]
+    last = keys[-1]
+    target[int(last) if isinstance(target, list) else last] = payload
+    return value
+
+
+def multipart_parts(body, content_type):
+    """
+    The parts of a multipart body as [name, headers, content] lists, plus the
+    boundary, or None when the body can't be split.
+    """
+    match = boundary_re.search(content_type)
+    if not match:
+        return None
+    boundary = b"--" + match.group(1).encode("latin-1")
+    parts = []
+    for chunk in body.split(boundary)[1:-1]:
+        headers, sep, content = chunk.strip(b"\r\n").partition(b"\r\n\r\n")
+        name = part_name_re.search(headers)
+        if not sep or not name:
+            return None
+        parts.append([name.group(1).decode("utf-8", "replace"), headers, content])
+    return parts, boundary
+
+
+def join_multipart(parts, boundary):
+    body = b"".join(
+        boundary + b"\r\n" + headers + b"\r\n\r\n" + content + b"\r\n"
+        for _, headers, content in parts
+    )
+    return body + boundary + b"--\r\n"
+
+
+def body_kind(request):
+    # the content type keeps its case, multipart boundaries are case sensitive
+    content_type = header_value(request["headers"], "content-type") or ""
+    if not request["body"]:
+        return None, content_type
+    for kind in ("x-www-form-urlencoded", "multipart/form-data", "json"):
+        if kind in content_type.lower():
+            return kind, content_type
+    return None, content_type
+
+
+def request_points(request):
+    """
+    Every (location, parameter, value) of request that can be fuzzed.
+    Locations are query, form, multipart, json, cookie, header and path.
+    """
+    parts = urlsplit(request["url"])
+    points = [("query", name, value) for name, value in parse_qsl(parts.query, True)]
+
+    kind, content_type = body_kind(request)
+    text = request["body"].decode("utf-8", errors="replace")
+    if kind == "x-www-form-urlencoded":
+        points += [("form", name, value) for name, value in parse_qsl(text, True)]
+    elif kind == "multipart/form-data":
+        split = multipart_parts(request["body"], content_type)
+        for name, headers, content in split[0] if split else []:
+            if b"filename=" not in headers:
+                points.append(("multipart", name, content.decode("utf-8", "replace")))
+    elif kind == "json":
+        try:
+            document = json.loads(text)
+        except ValueError:
+            document = None
+        if isinstance(document, (dict, list)):
+            points += [
+                ("json", path, value)
+                for path, value in json_fields(document)
+                if not isinstance(value, (dict, list))
+            ]
+
+    cookies = parse_cookie_header(header_value(request["headers"], "cookie"))
+    points += [("cookie", name, value) for name, value in cookies.items()]
+    for name in fuzzable_headers:
+        value = header_value(request["headers"], name)
+        if value is not None:
+            points.append(("header", name, value))
+
+    _, templated = route_template(parts.path)
+    points += [("path", str(index), value) for index, value in templated]
+    return points
+
+
+def parameter_value(request, parameter, location=None):
+    # the current value of parameter, None if request has no such parameter
+    locations = [location] if location else ["query", "form"]
+    for point_location, name, value in request_points(request):
+        if name == parameter and point_location in locations:
+            return value
+    return None
+
+
+def mutate_request(request, parameter, payload, location=None):
+    """
+    Copy of request with parameter set to payload. Without a location the
+    query string and then an urlencoded body are tried. Returns None when the
+    request has no such parameter.
+    """
+    if location is None:
+        for location in ("query", "form"):
+            mutated = mutate_request(request, parameter, payload, location)
+            if mutated:
+                return mutated
+        return None
+
+    if not any(
+        (point_location, name) == (location, parameter)
+        for point_location, name, _ in request_points(request)
+    ):
+        return None
+    mutated = dict(request, parameter=parameter, payload=payload, location=location)
+    parts = urlsplit(request["url"])
+    _, content_type = body_kind(request)
+
+    if location == "query":
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        query = [(name, payload if name == parameter else v) for name, v in query]
+        mutated["url"] = urlunsplit(parts._replace(query=urlencode(query)))
+    elif location == "form":
+        form = parse_qsl(request["body"].decode("utf-8", errors="replace"), True)
+        form = [(name, payload if name == parameter else v) for name, v in form]
+        mutated["body"] = urlencode(form).encode("utf-8")
+    elif location == "multipart":
+        parts_list, boundary = multipart_parts(request["body"], content_type)
+        for part in parts_list:
+            if part[0] == parameter:
+                part[2] = payload.encode("utf-8")
+        mutated["body"] = join_multipart(parts_list, boundary)
+    elif location == "json":
+        document = json.loads(request["body"].decode("utf-8", errors="replace"))
+        document = set_json_field(document, parameter, payload)
+        mutated["body"] = json.dumps(document).encode("utf-8")
+    elif location == "cookie":
+        cookies = parse_cookie_header(header_value(request["headers"], "cookie"))
+        cookies[parameter] = payload
+        cookie = "; ".join("{}={}".format(k, v) for k, v in cookies.items())
+        mutated["headers"] = replace_header(request["headers"], "Cookie", cookie)
+    elif location == "header":
+        mutated["headers"] = replace_header(request["headers"], parameter, payload)
+    elif location == "path":
+        segments = parts.path.split("/")
+        segments[int(parameter)] = quote(payload, safe="")
+        mutated["url"] = urlunsplit(parts._replace(path="/".join(segments)))
+    return mutated
+
+
+class InjectionPoints:
+    """
+    Deduplicated queue of injection points, fed capture records one at a time
+    or by following the capture file from a background thread. Each point is
+    a dict with method, route (the template), location, parameter, value and
+    the request to replay.
+    """
+
+    def __init__(self, scope=None):
+        # scope limits points to urls starting with one of these prefixes
+        self.scope = scope
+        self.queue = queue.Queue()
+        self.seen = set()
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def feed(self, record):
+        # queues the new points of record and returns them
+        if not replayable(record):
+            return []
+        url = record["url"]
+        if self.scope and not any(url.startswith(prefix) for prefix in self.scope):
+            return []
+        request = request_from_record(record)
+        route, _ = route_template(urlsplit(url).path)
+
+        new = []
+        with self.lock:
+            for location, parameter, value in request_points(request):
+                key = (request["method"], route, location, parameter)
+                if key in self.seen:
+                    continue
+                self.seen.add(key)
+                point = {
+                    "method": request["method"],
+                    "route": route,
+                    "location": location,
+                    "parameter": parameter,
+                    "value": value,
+                    "request": request,
+                }
+                self.routes.setdefault(route, []).append(point)
+                new.append(point)
+        for point in new:
+            self.queue.put(point)
+        return new
+
+    def load(self, path):
+        for record in read_capture(path):
+            self.feed(record)
+
+    def follow(self, path, stop=None, poll_interval=0.5, offset=0):
+        # keeps feeding records the proxy appends to path, from offset on, until stop is set
+        def run():
+            for record in follow_capture(path, poll_interval, stop, offset):
+                self.feed(record)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def get(self, timeout=None):
+        # the next point, or None once timeout seconds pass without one
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def parse_args(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="List the injection points in traffic captured by proxy.py"
+    )
+    parser.add_argument(
+        "--capture",
+        dest="capture",
+        default="capture.jsonl",
+        help="traffic recorded by proxy.py (default: capture.jsonl)",
+    )
+    parser.add_argument(
+        "--scope",
+        dest="scope",
+        action="append",
+        help="only urls starting with this prefix, can be repeated",
+    )
+    parser.add_argument(
+        "--follow",
+        dest="follow",
+        action="store_true",
+        help="keep printing points as the proxy captures more traffic",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    points = InjectionPoints(args.scope)
+    if args.follow:
+        points.follow(args.capture)
+    else:
+        points.load(args.capture)
+
+    while True:
+        point = points.get(timeout=None if args.follow else 0)
+        if point is None:
+            break
+        print(
+            "{method} {route} {location} {parameter}={value!r}".format(
+                **dict(point, value=str(point["value"])[:60])
+            )
+        )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,124 @@
+#
+# llm_cache.py
+#
+# On-disk cache of openai completions. The same login pages and module menus
+# come up again and again within a run and across runs, so completions are
+# stored in sqlite keyed by a hash of the full request (prompt, model and
+# sampling parameters) and a hit never touches the network. Callers that want
+# a different sample for the same request, another browser page or a retry
+# after every candidate was rejected, pass a sample label that is part of the
+# key.
+#
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import openai
+
+
+class CompletionCache:
+    def __init__(
+        self, path=".phreakbot_cache.sqlite", max_entries=10000, max_age=7 * 86400
+    ):
+        # max_age is in seconds; least recently used entries go first once
+        # there are more than max_entries
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, texts TEXT, created REAL, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS completions_last_used "
+                "ON completions (last_used)"
+            )
+        return self.db
+
+    @staticmethod
+    def key(request, sample=None):
+        if sample is not None:
+            request = {"request": request, "sample": sample}
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, request, sample=None):
+        key = self.key(request, sample)
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            row = db.execute(
+                "SELECT texts, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+            db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, request, texts, sample=None):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (self.key(request, sample), json.dumps(texts), now, now),
+            )
+            self.evict(db, now)
+            db.commit()
+
+    def evict(self, db, now):
+        db.execute("DELETE FROM completions WHERE created < ?", (now - self.max_age,))
+        db.execute(
+            "DELETE FROM completions WHERE key IN ("
+            "SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self):
+        with self.lock:
+            db = self.connect()
+            db.execute("DELETE FROM completions")
+            db.commit()
+
+
+default_cache = CompletionCache()
+
+
+def complete(request, cache=default_cache, sample=None):
+    """
+    openai.Completion.create(**request), returning the text of every choice.
+    Pass cache=None to always go to the API. Requests with different sample
+    labels are cached apart, so each label gets its own completions.
+    """
+    texts = cache.get(request, sample) if cache else None
+    if texts is None:
+        response = openai.Completion.create(**request)
+        texts = [choice.text for choice in response.choices]
+        if cache:
+            cache.put(request, texts, sample)
+    return texts
+
+
+async def acomplete(request, cache=default_cache, sample=None):
+    texts = cache.get(request, sample) if cache else None
+    if texts is None:
+        response = await openai.Completion.acreate(**request)
+        texts = [choice.text for choice in response.choices]
+        if cache:
+            cache.put(request, texts, sample)
+    return texts
@@ -5,28 +5,41 @@
 # Set OPENAI_API_KEY to your API key, and then run this from a terminal.
 #
 
+import argparse
 import os
 import time
-from sys import argv, exit, platform
+from sys import argv, exit
 
 import openai
 from dotenv import load_dotenv
 from langchain import PromptTemplate
-from playwright.sync_api import Route, sync_playwright
-
+from playwright.sync_api import Error, Route, sync_playwright
+
+from commands import (
+    Click,
+    ReturnDomain,
+    Scroll,
+    Type,
+    batch_commands,
+    changes_page,
+    parse_commands,
+    rank_commands,
+)
+from compact import compact_elements, compact_url
 from fuzzer import fuzz_prompt, vuln_recog_prompt
+from llm_cache import complete, default_cache
+from sitemap import ExplorationGraph
+from snapshot import (
+    build_element_table,
+    dom_settled_js,
+    dom_watcher_js,
+    parse_viewport,
+    render_elements,
+    viewport_state_js,
+)
 
 load_dotenv()
 
-quiet = False
-if len(argv) >= 2:
-    if argv[1] == "-q" or argv[1] == "--quiet":
-        quiet = True
-        print(
-            "Running in quiet mode (HTML and other content hidden); \n"
-            + "exercise caution when running suggested commands."
-        )
-
 browse_template = """
 You are an agent controlling a browser performing a bug bounty. You are given four things:
 
@@ -62,6 +75,8 @@ If you find yourself in an out of scope domain you should probably issue a comma
 
 Don't try to interact with elements that you can't see.
 
+NOT YET EXPLORED lists the elements in view you haven't acted on yet and other pages that still have some. Prefer them over repeating what you have already done.
+
 Here are some examples:
 
 EXAMPLE 1:
@@ -132,427 +147,405 @@ CURRENT BROWSER CONTENT:
 {browser_content}
 ------------------
 
-SCOPED DOMAIN: http://localhost
+SCOPED DOMAIN: {domain}
 CURRENT URL: {url}
-CREDENTIALS: admin:password
+CREDENTIALS: {credentials}
+NOT YET EXPLORED:
+{unvisited}
 PREVIOUS COMMAND: {previous_command}
 YOUR COMMAND:
 """
 
 browse_prompt = PromptTemplate(
-    input_variables=["url", "previous_command", "browser_content"],
+    input_variables=[
+        "domain",
+        "credentials",
+        "url",
+        "previous_command",
+        "browser_content",
+        "unvisited",
+    ],
     template=browse_template,
 )
 
 
-black_listed_elements = set(
-    [
-        "html",
-        "head",
-        "title",
-        "meta",
-        "iframe",
-        "body",
-        "script",
-        "style",
-        "path",
-        "svg",
-        "br",
-        "::marker",
-    ]
-)
+# scrolls by a number of window heights, negative is up
+scroll_js = "(pages) => { const el = document.scrollingElement || document.body; el.scrollTop = el.scrollTop + pages * window.innerHeight; }"
+
+# run on an element resolved from its backend node id, text nodes act through their parent.
+# click keeps links in the same page and doesn't depend on where the element is drawn
+click_element_js = """function () {
+    const el = this.nodeType === Node.ELEMENT_NODE ? this : this.parentElement;
+    const link = el.closest("a");
+    if (link) link.removeAttribute("target");
+    el.scrollIntoView({block: "center"});
+    el.click();
+}"""
+
+# sets the value of an input or textarea in one go, with the events frameworks
+# listen for. Returns false for elements without a value, they get typed into
+fill_element_js = """function (text) {
+    const el = this.nodeType === Node.ELEMENT_NODE ? this : this.parentElement;
+    el.scrollIntoView({block: "center"});
+    el.focus();
+    if (!("value" in el) || el.tagName === "BUTTON") return false;
+    const setter = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(el), "value");
+    if (setter && setter.set) setter.set.call(el, text);
+    else el.value = text;
+    el.dispatchEvent(new Event("input", {bubbles: true}));
+    el.dispatchEvent(new Event("change", {bubbles: true}));
+    return true;
+}"""
+
+
+def completion_request(
+    url,
+    previous_command,
+    elements,
+    n=3,
+    best_of=None,
+    token_budget=1200,
+    domain="http://localhost",
+    credentials="admin:password",
+    unvisited="",
+):
+    # elements is what Crawler.crawl returned, compacted to token_budget tokens.
+    # best_of > n pays for completions the API never returns, so it defaults to n.
+    # unvisited is ExplorationGraph.unvisited for the page
+    api_prompt = browse_prompt.format(
+        domain=domain,
+        credentials=credentials,
+        unvisited=unvisited or "unknown",
+        url=compact_url(url),
+        previous_command=previous_command,
+        browser_content=compact_elements(elements, token_budget),
+    )
+    return dict(
+        model="text-davinci-002",
+        prompt=api_prompt,
+        temperature=1.0,
+        best_of=best_of or n,
+        n=n,
+        max_tokens=50,
+    )
+
+
+def get_gpt_commands(
+    url,
+    previous_command,
+    elements,
+    n=3,
+    best_of=None,
+    cache=default_cache,
+    domain="http://localhost",
+    credentials="admin:password",
+    unvisited="",
+    sample=None,
+):
+    # sample is the llm_cache sample label, main counts retries with it
+    request = completion_request(
+        url,
+        previous_command,
+        elements,
+        n,
+        best_of,
+        domain=domain,
+        credentials=credentials,
+        unvisited=unvisited,
+    )
+    return complete(request, cache, sample)
+
+
+def run_commands(crawler, commands, domain):
+    """
+    Run parsed commands on crawler, only waiting for the page after the ones
+    that can navigate or rerender it and once at the end.
+    """
+    waited = 0
+    settled = True
+    for command in batch_commands(commands):
+        if isinstance(command, Scroll):
+            crawler.scroll(command.direction, command.pages)
+        elif isinstance(command, Click):
+            crawler.click(command.id)
+        elif isinstance(command, Type):
+            crawler.type(command.id, command.text, command.submit)
+        elif isinstance(command, ReturnDomain):
+            crawler.go_to_page(domain)
+        settled = changes_page(command)
+        if settled:
+            waited += crawler.wait_until_ready()
+    if not settled:
+        waited += crawler.wait_until_ready()
+    return waited
 
 
 class Crawler:
-    def __init__(self):
+    def __init__(
+        self,
+        wait_timeout=10000,
+        quiet_ms=250,
+        headless=False,
+        proxy="http://localhost:8181",
+    ):
+        # after an action, wait at most wait_timeout ms for the page to load and
+        # for the DOM to go quiet_ms without mutations
+        self.wait_timeout = wait_timeout
+        self.quiet_ms = quiet_ms
         self.browser = (
             sync_playwright()
             .start()
             .chromium.launch(
                 proxy={
-                    "server": "http://localhost:8181",
+                    "server": proxy,
                     "username": "",
                     "password": "",
                 },
-                headless=False,
+                headless=headless,
             )
         )
 
         self.page = self.browser.new_page()
         self.page.set_viewport_size({"width": 1280, "height": 1080})
+        self.page.add_init_script(dom_watcher_js)
+
+        self.element_table = None
+        self.dom_version = None
 
     def go_to_page(self, url):
         self.page.goto(url=url if "://" in url else "http://" + url)
         self.client = self.page.context.new_cdp_session(self.page)
         self.page_element_buffer = {}
+        self.element_table = None
+        self.dom_version = None
 
-    def scroll(self, direction):
+    def scroll(self, direction, pages=1):
         if direction == "up":
-            self.page.evaluate(
-                "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop - window.innerHeight;"
-            )
+            self.page.evaluate(scroll_js, -pages)
         elif direction == "down":
-            self.page.evaluate(
-                "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop + window.innerHeight;"
+            self.page.evaluate(scroll_js, pages)
+
+    def call_on_element(self, id, js, *args):
+        """
+        Call js with this bound to element id of the last crawl, found by its
+        backend node id so scrolling and reflows since don't matter. Returns
+        what js returned, or None when the element is gone.
+        """
+        element = self.page_element_buffer.get(int(id)) if str(id).isdigit() else None
+        if not element:
+            print("Could not find element")
+            return None
+        try:
+            node = self.client.send(
+                "DOM.resolveNode", {"backendNodeId": element["backend_node_id"]}
+            )
+            result = self.client.send(
+                "Runtime.callFunctionOn",
+                {
+                    "functionDeclaration": js,
+                    "objectId": node["object"]["objectId"],
+                    "arguments": [{"value": arg} for arg in args],
+                    "returnByValue": True,
+                },
             )
+        except Error as e:
+            print("Could not find element: {}".format(e.message))
+            return None
+        if "exceptionDetails" in result:
+            print(
+                "Could not act on element: {}".format(
+                    result["exceptionDetails"]["text"]
+                )
+            )
+            return None
+        return result["result"].get("value", True)
 
     def click(self, id):
-        # Inject javascript into the page which removes the target= attribute from all links
-        js = """
-		links = document.getElementsByTagName("a");
-		for (var i = 0; i < links.length; i++) {
-			links[i].removeAttribute("target");
-		}
-		"""
-        self.page.evaluate(js)
-
-        element = self.page_element_buffer.get(int(id))
-        if element:
-            x = element.get("center_x")
-            y = element.get("center_y")
-
-            self.page.mouse.click(x, y)
-        else:
-            print("Could not find element")
+        self.call_on_element(id, click_element_js)
 
-    def type(self, id, text):
-        self.click(id)
-        self.page.keyboard.type(text)
+    def type(self, id, text, submit=False):
+        filled = self.call_on_element(id, fill_element_js, text)
+        if filled is False:
+            # focused but has no value, e.g. contenteditable
+            self.page.keyboard.insert_text(text)
+        if filled is not None and submit:
+            self.enter()
 
     def enter(self):
         self.page.keyboard.press("Enter")
 
-    def crawl(self):
-        page = self.page
-        page_element_buffer = self.page_element_buffer
-        start = time.time()
-
-        page_state_as_text = []
-
-        device_pixel_ratio = page.evaluate("window.devicePixelRatio")
-        if platform == "darwin" and device_pixel_ratio == 1:  # lies
-            device_pixel_ratio = 2
-
-        win_scroll_x = page.evaluate("window.scrollX")
-        win_scroll_y = page.evaluate("window.scrollY")
-        win_upper_bound = page.evaluate("window.pageYOffset")
-        win_left_bound = page.evaluate("window.pageXOffset")
-        win_width = page.evaluate("window.screen.width")
-        win_height = page.evaluate("window.screen.height")
-        win_right_bound = win_left_bound + win_width
-        win_lower_bound = win_upper_bound + win_height
-        document_offset_height = page.evaluate("document.body.offsetHeight")
-        document_scroll_height = page.evaluate("document.body.scrollHeight")
-
-        # 		percentage_progress_start = (win_upper_bound / document_scroll_height) * 100
-        # 		percentage_progress_end = (
-        # 			(win_height + win_upper_bound) / document_scroll_height
-        # 		) * 100
-        percentage_progress_start = 1
-        percentage_progress_end = 2
-
-        page_state_as_text.append(
-            {
-                "x": 0,
-                "y": 0,
-                "text": "[scrollbar {:0.2f}-{:0.2f}%]".format(
-                    round(percentage_progress_start, 2), round(percentage_progress_end)
-                ),
-            }
-        )
-
-        tree = self.client.send(
-            "DOMSnapshot.captureSnapshot",
-            {"computedStyles": [], "includeDOMRects": True, "includePaintOrder": True},
-        )
-        strings = tree["strings"]
-        document = tree["documents"][0]
-        nodes = document["nodes"]
-        backend_node_id = nodes["backendNodeId"]
-        attributes = nodes["attributes"]
-        node_value = nodes["nodeValue"]
-        parent = nodes["parentIndex"]
-        node_types = nodes["nodeType"]
-        node_names = nodes["nodeName"]
-        is_clickable = set(nodes["isClickable"]["index"])
-
-        text_value = nodes["textValue"]
-        text_value_index = text_value["index"]
-        text_value_values = text_value["value"]
-
-        input_value = nodes["inputValue"]
-        input_value_index = input_value["index"]
-        input_value_values = input_value["value"]
-
-        input_checked = nodes["inputChecked"]
-        layout = document["layout"]
-        layout_node_index = layout["nodeIndex"]
-        bounds = layout["bounds"]
-
-        cursor = 0
-        html_elements_text = []
-
-        child_nodes = {}
-        elements_in_view_port = []
-
-        anchor_ancestry = {"-1": (False, None)}
-        button_ancestry = {"-1": (False, None)}
-
-        def convert_name(node_name, has_click_handler):
-            if node_name == "a":
-                return "link"
-            if node_name == "input":
-                return "input"
-            if node_name == "img":
-                return "img"
-            if (
-                node_name == "button" or has_click_handler
-            ):  # found pages that needed this quirk
-                return "button"
-            else:
-                return "text"
-
-        def find_attributes(attributes, keys):
-            values = {}
-
-            for [key_index, value_index] in zip(*(iter(attributes),) * 2):
-                if value_index < 0:
-                    continue
-                key = strings[key_index]
-                value = strings[value_index]
-
-                if key in keys:
-                    values[key] = value
-                    keys.remove(key)
-
-                    if not keys:
-                        return values
-
-            return values
-
-        def add_to_hash_tree(hash_tree, tag, node_id, node_name, parent_id):
-            parent_id_str = str(parent_id)
-            if not parent_id_str in hash_tree:
-                parent_name = strings[node_names[parent_id]].lower()
-                grand_parent_id = parent[parent_id]
-
-                add_to_hash_tree(
-                    hash_tree, tag, parent_id, parent_name, grand_parent_id
-                )
-
-            is_parent_desc_anchor, anchor_id = hash_tree[parent_id_str]
-
-            # even if the anchor is nested in another anchor, we set the "root" for all descendants to be ::Self
-            if node_name == tag:
-                value = (True, node_id)
-            elif (
-                is_parent_desc_anchor
-            ):  # reuse the parent's anchor_id (which could be much higher in the tree)
-                value = (True, anchor_id)
-            else:
-                value = (
-                    False,
-                    None,
-                )  # not a descendant of an anchor, most likely it will become text, an interactive element or discarded
-
-            hash_tree[str(node_id)] = value
-
-            return value
-
-        for index, node_name_index in enumerate(node_names):
-            node_parent = parent[index]
-            node_name = strings[node_name_index].lower()
-
-            is_ancestor_of_anchor, anchor_id = add_to_hash_tree(
-                anchor_ancestry, "a", index, node_name, node_parent
-            )
-
-            is_ancestor_of_button, button_id = add_to_hash_tree(
-                button_ancestry, "button", index, node_name, node_parent
-            )
+    def page_state(self):
+        # what the last crawl saw, equal states mean the command in between did nothing
+        if self.dom_version is None:
+            return None  # no mutation counter, so no way to tell
+        return (self.page.url, self.dom_version, self.viewport["top"])
 
+    def wait_until_ready(self):
+        start = time.time()
+        deadline = start + self.wait_timeout / 1000
+
+        def remaining():
+            # playwright treats a timeout of 0 as no timeout at all
+            return max((deadline - time.time()) * 1000, 1)
+
+        try:
+            # both resolve immediately when the current document already got there
+            self.page.wait_for_load_state("load", timeout=remaining())
+            self.page.wait_for_load_state("networkidle", timeout=remaining())
+        except Error:
+            pass
+
+        try:
+            self.page.evaluate(dom_settled_js, [self.quiet_ms, remaining()])
+        except Error:
+            # the action navigated while we were waiting, give the new document its load event
             try:
-                cursor = layout_node_index.index(
-                    index
-                )  # todo replace this with proper cursoring, ignoring the fact this is O(n^2) for the moment
-            except:
-                continue
-
-            if node_name in black_listed_elements:
-                continue
-
-            [x, y, width, height] = bounds[cursor]
-            x /= device_pixel_ratio
-            y /= device_pixel_ratio
-            width /= device_pixel_ratio
-            height /= device_pixel_ratio
-
-            elem_left_bound = x
-            elem_top_bound = y
-            elem_right_bound = x + width
-            elem_lower_bound = y + height
-
-            partially_is_in_viewport = (
-                elem_left_bound < win_right_bound
-                and elem_right_bound >= win_left_bound
-                and elem_top_bound < win_lower_bound
-                and elem_lower_bound >= win_upper_bound
-            )
-
-            if not partially_is_in_viewport:
-                continue
-
-            meta_data = []
+                self.page.wait_for_load_state("load", timeout=remaining())
+            except Error:
+                pass
 
-            # inefficient to grab the same set of keys for kinds of objects but its fine for now
-            element_attributes = find_attributes(
-                attributes[index], ["type", "placeholder", "aria-label", "title", "alt"]
-            )
+        waited = time.time() - start
+        print("Wait time: {:0.2f} seconds".format(waited))
+        return waited
 
-            ancestor_exception = is_ancestor_of_anchor or is_ancestor_of_button
-            ancestor_node_key = (
-                None
-                if not ancestor_exception
-                else str(anchor_id)
-                if is_ancestor_of_anchor
-                else str(button_id)
-            )
-            ancestor_node = (
-                None
-                if not ancestor_exception
-                else child_nodes.setdefault(str(ancestor_node_key), [])
-            )
+    def get_viewport(self):
+        # every page.evaluate is an IPC round-trip, so read all the metrics at once
+        return parse_viewport(self.page.evaluate(viewport_state_js))
 
-            if node_name == "#text" and ancestor_exception:
-                text = strings[node_value[index]]
-                if text == "|" or text == "•":
-                    continue
-                ancestor_node.append({"type": "type", "value": text})
-            else:
-                if (
-                    node_name == "input" and element_attributes.get("type") == "submit"
-                ) or node_name == "button":
-                    node_name = "button"
-                    element_attributes.pop(
-                        "type", None
-                    )  # prevent [button ... (button)..]
-
-                for key in element_attributes:
-                    if ancestor_exception:
-                        ancestor_node.append(
-                            {
-                                "type": "attribute",
-                                "key": key,
-                                "value": element_attributes[key],
-                            }
-                        )
-                    else:
-                        meta_data.append(element_attributes[key])
-
-            element_node_value = None
+    def crawl(self):
+        start = time.time()
 
-            if node_value[index] >= 0:
-                element_node_value = strings[node_value[index]]
-                if (
-                    element_node_value == "|"
-                ):  # commonly used as a seperator, does not add much context - lets save ourselves some token space
-                    continue
-            elif (
-                node_name == "input"
-                and index in input_value_index
-                and element_node_value is None
-            ):
-                node_input_text_index = input_value_index.index(index)
-                text_index = input_value_values[node_input_text_index]
-                if node_input_text_index >= 0 and text_index >= 0:
-                    element_node_value = strings[text_index]
-
-            # remove redudant elements
-            if ancestor_exception and (node_name != "a" and node_name != "button"):
-                continue
-
-            elements_in_view_port.append(
+        viewport = self.get_viewport()
+        self.viewport = viewport
+
+        # scrolling or a click that did nothing only needs the viewport filter redone
+        dom_version = viewport["dom_version"]
+        if (
+            self.element_table is None
+            or dom_version is None
+            or dom_version != self.dom_version
+        ):
+            tree = self.client.send(
+                "DOMSnapshot.captureSnapshot",
                 {
-                    "node_index": str(index),
-                    "backend_node_id": backend_node_id[index],
-                    "node_name": node_name,
-                    "node_value": element_node_value,
-                    "node_meta": meta_data,
-                    "is_clickable": index in is_clickable,
-                    "origin_x": int(x),
-                    "origin_y": int(y),
-                    "center_x": int(x + (width / 2)),
-                    "center_y": int(y + (height / 2)),
-                }
+                    "computedStyles": [],
+                    "includeDOMRects": True,
+                    "includePaintOrder": True,
+                },
+            )
+            self.element_table = build_element_table(
+                tree, viewport["device_pixel_ratio"]
             )
+            self.dom_version = dom_version
 
-        # lets filter further to remove anything that does not hold any text nor has click handlers + merge text from leaf#text nodes with the parent
-        elements_of_interest = []
-        id_counter = 0
-
-        for element in elements_in_view_port:
-            node_index = element.get("node_index")
-            node_name = element.get("node_name")
-            node_value = element.get("node_value")
-            is_clickable = element.get("is_clickable")
-            origin_x = element.get("origin_x")
-            origin_y = element.get("origin_y")
-            center_x = element.get("center_x")
-            center_y = element.get("center_y")
-            meta_data = element.get("node_meta")
-
-            inner_text = f"{node_value} " if node_value else ""
-            meta = ""
-
-            if node_index in child_nodes:
-                for child in child_nodes.get(node_index):
-                    entry_type = child.get("type")
-                    entry_value = child.get("value")
-
-                    if entry_type == "attribute":
-                        entry_key = child.get("key")
-                        meta_data.append(f'{entry_key}="{entry_value}"')
-                    else:
-                        inner_text += f"{entry_value} "
-
-            if meta_data:
-                meta_string = " ".join(meta_data)
-                meta = f" {meta_string}"
-
-            if inner_text != "":
-                inner_text = f"{inner_text.strip()}"
-
-            converted_node_name = convert_name(node_name, is_clickable)
-
-            # not very elegant, more like a placeholder
-            if (
-                (converted_node_name != "button" or meta == "")
-                and converted_node_name != "link"
-                and converted_node_name != "input"
-                and converted_node_name != "img"
-                and converted_node_name != "textarea"
-            ) and inner_text.strip() == "":
-                continue
-
-            page_element_buffer[id_counter] = element
-
-            if inner_text != "":
-                elements_of_interest.append(
-                    f"""<{converted_node_name} id={id_counter}{meta}>{inner_text}</{converted_node_name}>"""
-                )
-            else:
-                elements_of_interest.append(
-                    f"""<{converted_node_name} id={id_counter}{meta}/>"""
-                )
-            id_counter += 1
+        elements_of_interest, self.page_element_buffer = render_elements(
+            self.element_table,
+            (viewport["left"], viewport["top"], viewport["right"], viewport["bottom"]),
+        )
 
         print("Parsing time: {:0.2f} seconds".format(time.time() - start))
         return elements_of_interest
 
 
-if __name__ == "__main__":
-    DOMAIN = "http://localhost"
-    _crawler = Crawler()
+def parse_args(argv=argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Let GPT browse an in-scope domain, step by step or on its own"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        dest="quiet",
+        action="store_true",
+        help="don't print the page content GPT sees",
+    )
+    parser.add_argument(
+        "--domain",
+        dest="domain",
+        default="http://localhost",
+        help="in-scope domain, also used for RETURN DOMAIN (default: http://localhost)",
+    )
+    parser.add_argument(
+        "--credentials",
+        dest="credentials",
+        default="admin:password",
+        help="username:password for the in-scope domain (default: admin:password)",
+    )
+    parser.add_argument(
+        "--proxy",
+        dest="proxy",
+        default="http://localhost:8181",
+        help="proxy for the browser (default: http://localhost:8181)",
+    )
+    parser.add_argument(
+        "--candidates",
+        dest="n",
+        type=int,
+        default=3,
+        help="completions to request per step, spares are tried when a command does nothing (default: 3)",
+    )
+    parser.add_argument(
+        "--best-of",
+        dest="best_of",
+        type=int,
+        default=None,
+        help="completions generated server side to pick the candidates from (default: --candidates)",
+    )
+    parser.add_argument(
+        "--auto",
+        dest="auto",
+        action="store_true",
+        help="run every suggested command without asking, until a budget runs out",
+    )
+    parser.add_argument(
+        "--headless",
+        dest="headless",
+        action="store_true",
+        help="don't show the browser window",
+    )
+    parser.add_argument(
+        "--max-steps",
+        dest="max_steps",
+        type=int,
+        default=50,
+        help="commands to run in --auto mode (default: 50)",
+    )
+    parser.add_argument(
+        "--max-time",
+        dest="max_time",
+        type=float,
+        default=900,
+        help="seconds to run for in --auto mode (default: 900)",
+    )
+    parser.add_argument(
+        "--max-llm-calls",
+        dest="max_llm_calls",
+        type=int,
+        default=100,
+        help="completions to request in --auto mode, cache hits included (default: 100)",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        dest="wait_timeout",
+        type=int,
+        default=10000,
+        help="ms to wait for the page to settle after each command (default: 10000)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=argv[1:]):
+    args = parse_args(argv)
+    quiet = args.quiet
+    if quiet:
+        print(
+            "Running in quiet mode (HTML and other content hidden); \n"
+            + "exercise caution when running suggested commands."
+        )
+
+    DOMAIN = args.domain
+    _crawler = Crawler(
+        wait_timeout=args.wait_timeout, headless=args.headless, proxy=args.proxy
+    )
     openai.api_key = os.environ.get("OPENAI_API_KEY")
 
     def print_help():
@@ -561,91 +554,189 @@ if __name__ == "__main__":
             + "(h) to view commands again\n(r/enter) to run suggested command\n(o) change objective"
         )
 
-    def get_gpt_command(url, previous_command, browser_content):
-        api_prompt = browse_prompt.format(
-            url=url[:100],
-            previous_command=previous_command,
-            browser_content=browser_content[:4500],
-        )
-        response = openai.Completion.create(
-            model="text-davinci-002",
-            prompt=api_prompt,
-            temperature=1.0,
-            best_of=10,
-            n=3,
-            max_tokens=50,
-        )
-        return response.choices[0].text
-
     def run_cmd(cmd):
         print("The GPT suggested command is {}".format(cmd))
-        cmds = cmd.split("\n")
-        for cmd in cmds:
-            print("THE TOTAL COMMAND LIST:")
-            print(cmd)
-            if cmd.startswith("SCROLL UP"):
-                _crawler.scroll("up")
-            elif cmd.startswith("SCROLL DOWN"):
-                _crawler.scroll("down")
-            elif cmd.startswith("CLICK"):
-                commasplit = cmd.split(",")
-                id = commasplit[0].split(" ")[1]
-                _crawler.click(id)
-            elif cmd.startswith("TYPE"):
-                spacesplit = cmd.split(" ")
-                id = spacesplit[1]
-                text = spacesplit[2:]
-                text = " ".join(text)
-                # Strip leading and trailing double quotes
-                text = text[1:-1]
-                if cmd.startswith("TYPESUBMIT"):
-                    text += "\n"
-                _crawler.type(id, text)
-            elif cmd.startswith("RETURN DOMAIN"):
-                _crawler.go_to_page(DOMAIN)
-            time.sleep(2)
+        commands, errors = parse_commands(cmd)
+        for line, reason in errors:
+            print("Skipping {!r}: {}".format(line, reason))
+        run_commands(_crawler, commands, DOMAIN)
+
+    def over_budget():
+        if summary["steps"] >= args.max_steps:
+            return "step budget"
+        if time.time() - start >= args.max_time:
+            return "time budget"
+        if summary["llm_calls"] >= args.max_llm_calls:
+            return "LLM call budget"
+        return None
 
     print("\nWelcome to phreakbot!")
     print(f'Pentest beginning on in-scope domain: "{DOMAIN}"')
+    start = time.time()
+    summary = {"steps": 0, "llm_calls": 0, "errors": 0, "urls": set(), "commands": []}
     gpt_cmd = ""
     prev_cmd = ""
-    _crawler.go_to_page(DOMAIN)
+    spare_cmds = []
+    ran_suggestion = False
+    last_state = None
+    stop_reason = "interrupted"
+    graph = ExplorationGraph()
+    node = None
+    need_domain = True
+    retries = 0
     try:
         while True:
-            browser_content = "\n".join(_crawler.crawl())
-            prev_cmd = gpt_cmd
-            gpt_cmd = get_gpt_command(_crawler.page.url, prev_cmd, browser_content)
-            gpt_cmd = gpt_cmd.strip()
-
-            if not quiet:
-                print("URL: " + _crawler.page.url)
-                print("----------------\n" + browser_content + "\n----------------\n")
-            if len(gpt_cmd) > 0:
-                print("Suggested command: " + gpt_cmd)
-
-            command = input()
-            if command == "r" or command == "":
-                run_cmd(gpt_cmd)
-            elif command == "g":
-                url = input("URL:")
-                _crawler.go_to_page(url)
-            elif command == "u":
-                _crawler.scroll("up")
-                time.sleep(1)
-            elif command == "d":
-                _crawler.scroll("down")
-                time.sleep(1)
-            elif command == "c":
-                id = input("id:")
-                _crawler.click(id)
-                time.sleep(1)
-            elif command == "t":
-                id = input("id:")
-                text = input("text:")
-                _crawler.type(id, text)
-                time.sleep(1)
-            else:
-                print_help()
+            if args.auto:
+                stop_reason = over_budget()
+                if stop_reason:
+                    break
+            try:
+                if need_domain:
+                    _crawler.go_to_page(DOMAIN)
+                    need_domain = False
+                elements = _crawler.crawl()
+                browser_content = "\n".join(elements)
+                state = _crawler.page_state()
+                summary["urls"].add(_crawler.page.url)
+                node = graph.observe(
+                    _crawler.page.url,
+                    elements,
+                    node,
+                    gpt_cmd if ran_suggestion else None,
+                )
+                if args.auto and graph.exhausted(node):
+                    # been here and tried everything, no need to ask GPT again
+                    url = graph.frontier(exclude=node[0])
+                    if url:
+                        print("Already explored this page, going to " + url)
+                        summary["steps"] += 1
+                        _crawler.go_to_page(url)
+                        _crawler.wait_until_ready()
+                        ran_suggestion = False
+                        continue
+                prev_cmd = gpt_cmd
+                if ran_suggestion and state and state == last_state and spare_cmds:
+                    # the suggestion did nothing, the runner-up was checked against this same page
+                    gpt_cmd = spare_cmds.pop(0)
+                    print(
+                        "Suggested command had no effect, falling back to the next one"
+                    )
+                else:
+                    summary["llm_calls"] += 1
+                    gpt_cmds, rejected = rank_commands(
+                        get_gpt_commands(
+                            _crawler.page.url,
+                            prev_cmd,
+                            elements,
+                            args.n,
+                            args.best_of,
+                            domain=DOMAIN,
+                            credentials=args.credentials,
+                            unvisited=graph.unvisited(node, elements),
+                            # a fresh sample after a step that got nothing
+                            # usable, not the cached rejects again
+                            sample=retries,
+                        ),
+                        _crawler.page_element_buffer,
+                    )
+                    retries = 0 if gpt_cmds else retries + 1
+                    for cmd, problems in rejected:
+                        print(
+                            "Rejected suggestion {!r}: {}".format(
+                                cmd, "; ".join(problems)
+                            )
+                        )
+                    gpt_cmds = graph.prefer_unexplored(gpt_cmds, node, elements)
+                    gpt_cmd = gpt_cmds[0] if gpt_cmds else ""
+                    spare_cmds = gpt_cmds[1:]
+                last_state = state
+                ran_suggestion = False
+
+                if not quiet:
+                    print("URL: " + _crawler.page.url)
+                    print(
+                        "----------------\n" + browser_content + "\n----------------\n"
+                    )
+                if len(gpt_cmd) > 0:
+                    print("Suggested command: " + gpt_cmd)
+
+                if args.auto:
+                    # nothing usable on this page, start over from the domain
+                    cmd = gpt_cmd or "RETURN DOMAIN"
+                    summary["steps"] += 1
+                    summary["commands"].append(cmd)
+                    graph.record(node, cmd, elements)
+                    try:
+                        run_cmd(cmd)
+                    except Error as e:
+                        summary["errors"] += 1
+                        print("Error running {!r}: {}".format(cmd, e))
+                    ran_suggestion = True
+                    continue
+
+                command = input()
+                if command == "r" or command == "":
+                    graph.record(node, gpt_cmd, elements)
+                    run_cmd(gpt_cmd)
+                    ran_suggestion = True
+                elif command == "g":
+                    url = input("URL:")
+                    _crawler.go_to_page(url)
+                elif command == "u":
+                    _crawler.scroll("up")
+                    _crawler.wait_until_ready()
+                elif command == "d":
+                    _crawler.scroll("down")
+                    _crawler.wait_until_ready()
+                elif command == "c":
+                    id = input("id:")
+                    graph.record(node, "CLICK " + id, elements)
+                    _crawler.click(id)
+                    _crawler.wait_until_ready()
+                elif command == "t":
+                    id = input("id:")
+                    text = input("text:")
+                    graph.record(node, 'TYPE {} "{}"'.format(id, text), elements)
+                    _crawler.type(id, text)
+                    _crawler.wait_until_ready()
+                else:
+                    print_help()
+            except (Error, openai.error.OpenAIError) as e:
+                # a navigation timeout or an API error costs an unattended run a
+                # step, not the run and its summary
+                if not args.auto:
+                    raise
+                summary["steps"] += 1
+                summary["errors"] += 1
+                print("Error: {}".format(e))
     except KeyboardInterrupt:
         print("\n[!] Ctrl+C detected, exiting gracefully.")
-        exit(0)
+
+    if args.auto:
+        print("\nStopped: {}".format(stop_reason))
+        print(
+            "Ran {} commands ({} failed) with {} completions in {:0.1f} seconds".format(
+                summary["steps"],
+                summary["errors"],
+                summary["llm_calls"],
+                time.time() - start,
+            )
+        )
+        print(
+            "Explored {pages} pages in {states} states, {unexplored} elements "
+            "left untried".format(**graph.summary())
+        )
+        for url in graph.summary()["forms"]:
+            print("  form on " + url)
+        print("Visited {} urls:".format(len(summary["urls"])))
+        for url in sorted(summary["urls"]):
+            print("  " + url)
+        if default_cache:
+            print(
+                f"GPT cache: {default_cache.hits} hits, {default_cache.misses} misses"
+            )
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
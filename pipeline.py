@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#
+# pipeline.py
+#
+# Runs the whole scan unattended, with every stage going at once: browser
+# pages explore the target through an in-process proxy, injection points are
+# pulled out of the capture as it grows, fuzzers work through the points and
+# suspicious results are batched up for GPT. Stages are asyncio tasks joined by
+# bounded queues, so fuzzing the first form found overlaps with browsing for
+# the next and a slow stage holds the ones before it back instead of piling up
+# work.
+#
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import openai
+
+import proxy
+from async_crawler import run_pool
+from baseline import Baseline
+from corpus import PayloadCorpus
+from fuzzer import FuzzEngine, aget_fuzz_payloads
+from injection import InjectionPoints, mutate_request
+from llm_cache import CompletionCache
+from recognize import Recognizer
+
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.cache = CompletionCache(args.cache) if args.cache else None
+        self.corpus = PayloadCorpus(args.corpus)
+        self.points = InjectionPoints([args.domain])
+        self.point_queue = None
+        self.candidate_queue = None
+        self.recognizer = Recognizer(
+            args.tech_stack, batch_size=args.batch_size, cache=self.cache
+        )
+        self.topped_up = set()
+        self.findings = []
+        self.fuzzed = 0
+        self.sent = 0
+        self.start = None
+        self.first_finding = None
+
+    async def extract(self, browsing):
+        # moves points from the capture follower thread onto the bounded queue
+        loop = asyncio.get_running_loop()
+        idle = 0
+        while True:
+            point = await loop.run_in_executor(None, self.points.get, 0.5)
+            if point is not None:
+                idle = 0
+                await self.point_queue.put(point)
+            elif browsing.done():
+                # give the capture writer and the follower a moment to catch up
+                idle += 1
+                if idle > 4:
+                    break
+        for _ in range(self.args.fuzzers):
+            await self.point_queue.put(None)
+
+    async def payloads_for(self, point, attack):
+        # the corpus's best payloads, GPT tops the corpus up in the background
+        value = str(point["value"])
+        args = (point["route"], point["parameter"], value, attack, self.cache)
+        payloads = self.corpus.top(attack, self.args.top)
+        if not payloads:
+            self.corpus.add(attack, await aget_fuzz_payloads(*args))
+            return self.corpus.top(attack, self.args.top)
+        key = (point["route"], point["parameter"], attack)
+        if key not in self.topped_up:
+            self.topped_up.add(key)
+            asyncio.ensure_future(self.top_up(attack, args))
+        return payloads
+
+    async def top_up(self, attack, args):
+        try:
+            self.corpus.add(attack, await aget_fuzz_payloads(*args))
+        except openai.error.OpenAIError as e:
+            print(f"[fuzz] GPT error: {e}")
+
+    async def fuzz(self, name, engine):
+        while True:
+            point = await self.point_queue.get()
+            if point is None:
+                return
+            try:
+                await self.fuzz_point(name, engine, point)
+            except Exception as e:
+                # one bad point (a locked corpus, a request that can't be built)
+                # shouldn't end an unattended scan
+                print(
+                    "[{}] {} {} {} failed: {!r}".format(
+                        name, point["route"], point["location"], point["parameter"], e
+                    )
+                )
+
+    async def fuzz_point(self, name, engine, point):
+        request = point["request"]
+        original = mutate_request(
+            request, point["parameter"], point["value"], point["location"]
+        )
+        baseline = Baseline()
+        for result in await engine.run([original] * self.args.baseline_samples):
+            if not result["error"]:
+                baseline.add(result)
+        if not baseline.samples:
+            return
+
+        for attack in self.args.attacks:
+            try:
+                payloads = await self.payloads_for(point, attack)
+            except openai.error.OpenAIError as e:
+                print(f"[{name}] GPT error: {e}")
+                continue
+            candidates = []
+
+            def on_result(result):
+                candidate = self.recognizer.examine(result, baseline)
+                if candidate:
+                    candidate.update(
+                        route=point["route"],
+                        location=point["location"],
+                        attack=attack,
+                    )
+                    candidates.append(candidate)
+
+            requests = [
+                mutate_request(request, point["parameter"], p, point["location"])
+                for p in payloads
+            ]
+            await engine.run(requests, on_result)
+            self.sent += len(requests)
+            self.corpus.record(attack, payloads)
+            print(
+                "[{}] {} {} {}: {} payloads, {} suspicious".format(
+                    name,
+                    point["route"],
+                    point["location"],
+                    point["parameter"],
+                    len(payloads),
+                    len(candidates),
+                )
+            )
+            for candidate in candidates:
+                await self.candidate_queue.put(candidate)
+        self.fuzzed += 1
+
+    async def recognize(self):
+        # waits for up to batch_size candidates before asking GPT about them
+        done = False
+        while not done:
+            candidate = await self.candidate_queue.get()
+            if candidate is None:
+                break
+            batch = [candidate]
+            while len(batch) < self.args.batch_size:
+                try:
+                    candidate = await asyncio.wait_for(self.candidate_queue.get(), 1)
+                except asyncio.TimeoutError:
+                    break
+                if candidate is None:
+                    done = True
+                    break
+                batch.append(candidate)
+
+            try:
+                findings = await self.recognizer.arecognize(batch)
+            except openai.error.OpenAIError as e:
+                print(f"[recognize] GPT error: {e}")
+                continue
+            for finding in findings:
+                if finding["vulnerable"]:
+                    self.report(finding)
+
+    def report(self, finding):
+        elapsed = time.time() - self.start
+        if self.first_finding is None:
+            self.first_finding = elapsed
+        self.findings.append(finding)
+        self.corpus.record(finding["attack"], [], [finding["payload"]])
+        print(
+            "[{:0.1f}s] FINDING {attack} in {route} {location} {parameter}: "
+            "{payload!r} {reason}".format(elapsed, **finding)
+        )
+        if self.args.findings:
+            with open(self.args.findings, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(finding, time=time.time())) + "\n")
+
+    async def run(self, httpd):
+        args = self.args
+        self.start = time.time()
+        self.point_queue = asyncio.Queue(args.queue_size)
+        self.candidate_queue = asyncio.Queue(args.queue_size)
+        stop = threading.Event()
+        # the proxy appends to the capture across runs, only this run's traffic is new
+        offset = os.path.getsize(args.capture) if os.path.exists(args.capture) else 0
+        self.points.follow(args.capture, stop, poll_interval=0.1, offset=offset)
+
+        engine = FuzzEngine(
+            per_host=args.per_host,
+            rate=args.rate,
+            sessions=httpd.sessions,
+            verbose=False,
+        )
+        browsing = asyncio.ensure_future(
+            run_pool(
+                args.domain,
+                args.urls,
+                args.pages,
+                args.steps,
+                "http://127.0.0.1:{}".format(args.port),
+                args.headless,
+                args.wait_timeout,
+                cache=self.cache,
+                credentials=args.credentials,
+            )
+        )
+        extracting = asyncio.ensure_future(self.extract(browsing))
+        recognizing = asyncio.ensure_future(self.recognize())
+        await asyncio.gather(
+            *(self.fuzz(f"fuzz {i}", engine) for i in range(args.fuzzers))
+        )
+        await self.candidate_queue.put(None)
+        await asyncio.gather(browsing, extracting, recognizing)
+        stop.set()
+
+        print(
+            "Fuzzed {} injection points with {} requests in {:0.1f} seconds".format(
+                self.fuzzed, self.sent, time.time() - self.start
+            )
+        )
+        if self.first_finding is not None:
+            print(
+                "{} findings, the first after {:0.1f} seconds".format(
+                    len(self.findings), self.first_finding
+                )
+            )
+        else:
+            print("No findings")
+        return {
+            "domain": args.domain,
+            "fuzzed": self.fuzzed,
+            "sent": self.sent,
+            "seconds": time.time() - self.start,
+            "first_finding": self.first_finding,
+            "findings": self.findings,
+        }
+
+
+def parse_args(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Browse, capture, fuzz and recognize vulnerabilities all at once"
+    )
+    parser.add_argument(
+        "--domain",
+        dest="domain",
+        default="http://localhost",
+        help="in-scope domain, also where browsing starts (default: http://localhost)",
+    )
+    parser.add_argument(
+        "--credentials",
+        dest="credentials",
+        default="admin:password",
+        help="username:password for the in-scope domain (default: admin:password)",
+    )
+    parser.add_argument(
+        "--url",
+        dest="urls",
+        action="append",
+        help="start url, may be repeated (default: the domain)",
+    )
+    parser.add_argument("--pages", dest="pages", type=int, default=2)
+    parser.add_argument("--steps", dest="steps", type=int, default=10)
+    parser.add_argument(
+        "--wait-timeout",
+        dest="wait_timeout",
+        type=int,
+        default=10000,
+        help="ms to wait for the page to settle after each command (default: 10000)",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=8181,
+        help="port of the proxy the browser pages use (default: 8181)",
+    )
+    parser.add_argument(
+        "--capture",
+        dest="capture",
+        default="capture.jsonl",
+        help="where the proxy records traffic (default: capture.jsonl)",
+    )
+    parser.add_argument(
+        "--sessions",
+        dest="sessions",
+        default="sessions.txt",
+        help="cookie jar shared by the browser and the fuzzer (default: sessions.txt)",
+    )
+    parser.add_argument(
+        "--attack",
+        dest="attacks",
+        action="append",
+        help="target attack, may be repeated (default: sql injection and reflected-xss)",
+    )
+    parser.add_argument(
+        "--fuzzers",
+        dest="fuzzers",
+        type=int,
+        default=4,
+        help="injection points fuzzed at once (default: 4)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        default=100,
+        help="points or candidates a stage can get ahead of the next (default: 100)",
+    )
+    parser.add_argument(
+        "--corpus",
+        dest="corpus",
+        default=".phreakbot_payloads.sqlite",
+        help="payloads kept across runs (default: .phreakbot_payloads.sqlite)",
+    )
+    parser.add_argument("--top", dest="top", type=int, default=50)
+    parser.add_argument(
+        "--baseline-samples", dest="baseline_samples", type=int, default=3
+    )
+    parser.add_argument("--per-host", dest="per_host", type=int, default=50)
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        type=float,
+        help="requests per second (default: no limit)",
+    )
+    parser.add_argument(
+        "--tech-stack",
+        dest="tech_stack",
+        default="unknown",
+        help="what the target runs on, for the recognition prompt",
+    )
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=5)
+    parser.add_argument(
+        "--findings",
+        dest="findings",
+        default="findings.jsonl",
+        help="append every finding to this file (default: findings.jsonl)",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=".phreakbot_cache.sqlite",
+        help="sqlite file to cache GPT completions in (default: .phreakbot_cache.sqlite)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_const",
+        const=None,
+        help="always ask the API",
+    )
+    parser.add_argument(
+        "--headed",
+        dest="headless",
+        action="store_false",
+        help="show the browser windows",
+    )
+    args = parser.parse_args(argv)
+    args.attacks = args.attacks or ["sql injection", "reflected-xss"]
+    return args
+
+
+def scan(args):
+    # one pipeline run with its own proxy, returns Pipeline.run's summary
+    proxy_args = proxy.parse_args(
+        [
+            "--port",
+            str(args.port),
+            "--capture",
+            args.capture,
+            "--sessions",
+            args.sessions,
+        ]
+    )
+    httpd = proxy.make_server(proxy_args)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print("proxy is running on port {}".format(args.port))
+    try:
+        return asyncio.run(Pipeline(args).run(httpd))
+    finally:
+        httpd.shutdown()
+        proxy.close_server(httpd)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    try:
+        scan(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,223 +1,437 @@
 import argparse
-import http.cookiejar
-import http.cookies
-import io
+import http.client
+import ipaddress
 import logging
 import os
 import random
+import select
+import socket
+import ssl
+import subprocess
 import sys
-import urllib.error
+import threading
+import time
 import urllib.parse
-import urllib.request
-import urllib.response
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+
+from capture import BodyTap, TrafficCapture
+from sessions import SessionStore
 
 logging.basicConfig()
 
 logger = logging.getLogger(__name__)
 
 
-class PassThroughRedirectHandler(urllib.request.HTTPRedirectHandler):
-    # alternative handler
-    def http_error_300(self, req, fp, code, msg, header_list):
-        data = urllib.response.addinfourl(fp, header_list, req.get_full_url())
-        data.status = code
-        data.code = code
+hop_by_hop_headers = set(
+    [
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailers",
+        "transfer-encoding",
+        "upgrade",
+    ]
+)
+
+
+# bodies are copied between the sockets in pieces of this size, request bodies
+# up to buffered_body_limit are read whole so they can be logged and retried
+stream_chunk_size = 64 * 1024
+buffered_body_limit = 64 * 1024
 
-        return data
 
-    # setup aliases
-    http_error_301 = http_error_300
-    http_error_302 = http_error_300
-    http_error_303 = http_error_300
-    http_error_307 = http_error_300
+class BodyReader:
+    # file-like view of the next length bytes of a request body
+    def __init__(self, rfile, length, tap):
+        self.rfile = rfile
+        self.remaining = length
+        self.tap = tap
 
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(min(size, stream_chunk_size))
+        self.remaining = self.remaining - len(data) if data else 0
+        return self.tap.update(data)
+
+
+def read_chunked(rfile, tap):
+    # decode a Transfer-Encoding: chunked request body, one bounded piece at a time
+    while True:
+        size = int(rfile.readline().split(b";")[0].strip(), 16)
+        if size == 0:
+            break
+        while size > 0:
+            data = rfile.read(min(size, stream_chunk_size))
+            if not data:
+                return
+            size -= len(data)
+            yield tap.update(data)
+        rfile.readline()
+    # skip trailers up to the blank line that ends the body
+    while rfile.readline() not in (b"\r\n", b"\n", b""):
+        pass
 
-opener = urllib.request.build_opener(PassThroughRedirectHandler)
-urllib.request.install_opener(opener)
+
+class UpstreamPool:
+    """
+    Keep-alive connections to upstream hosts, shared by all handler threads.
+    Redirects are passed through to the browser untouched, http.client never
+    follows them.
+    """
+
+    def __init__(self, max_idle=8, timeout=30):
+        # max_idle connections are kept per (scheme, host:port)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        # targets are test boxes with self-signed certificates more often than not
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    def acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+        scheme, netloc = key
+        if scheme == "https":
+            return (
+                http.client.HTTPSConnection(
+                    netloc, timeout=self.timeout, context=self.ssl_context
+                ),
+                False,
+            )
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def request(self, method, url, headers, body=None, chunked=False):
+        # body is bytes, or a file-like/iterable streamed as it is read; chunked
+        # re-frames an iterable body with Transfer-Encoding: chunked
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme or "http", parts.netloc)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        headers = [
+            (name, value)
+            for name, value in headers
+            if name.lower() not in hop_by_hop_headers
+        ]
+
+        if chunked:
+            headers.append(("Transfer-Encoding", "chunked"))
+        # a streamed body is gone once sent, so it can't be replayed on a fresh connection
+        replayable = body is None or isinstance(body, bytes)
+
+        while True:
+            conn, reused = self.acquire(key)
+            try:
+                conn.putrequest(method, path, skip_host=True, skip_accept_encoding=True)
+                for name, value in headers:
+                    conn.putheader(name, value)
+                conn.endheaders(body, encode_chunked=chunked)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                if reused and replayable:
+                    continue  # the host timed out an idle keep-alive connection, try a fresh one
+                raise
+            except Exception:
+                conn.close()
+                raise
+            resp.upstream = (key, conn)
+            return resp
+
+    def release(self, resp):
+        # call once the body has been read; unread or non keep-alive connections are closed
+        key, conn = getattr(resp, "upstream", (None, None))
+        if conn is None:
+            return
+        resp.upstream = (None, None)
+        if not resp.isclosed() or resp.will_close:
+            conn.close()
+            return
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
 
 
 class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
+    # keep the browser's connection to us open too, every response carries a Content-Length
+    protocol_version = "HTTP/1.1"
+    tunnel_origin = None
+
     def send_response(self, code, message=None):
         # this is a proxy, so I don't want it to add headers. i want to inherit all of these headers.
         self.log_request(code)
         self.send_response_only(code, message)
 
+    def send_upstream_response(self, resp, body, tap):
+        self.send_response(resp.status)
+        for name, value in resp.getheaders():
+            # the upstream connection is ours to keep alive, the body is re-framed below
+            if name.lower() in hop_by_hop_headers:
+                continue
+            self.send_header(keyword=name, value=value)
+
+        has_body = (
+            self.command != "HEAD"
+            and resp.status >= 200
+            and resp.status not in (204, 304)
+        )
+        chunked = False
+        if has_body and resp.getheader("Content-Length") is None:
+            if self.protocol_version == self.request_version == "HTTP/1.1":
+                self.send_header("Transfer-Encoding", "chunked")
+                chunked = True
+            else:
+                # HTTP/1.0 clients read the body up to the end of the connection
+                self.close_connection = True
+        self.end_headers()
+
+        if not (body and has_body):
+            return
+        while True:
+            data = resp.read(stream_chunk_size)
+            if not data:
+                break
+            tap.update(data)
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
     def do_HEAD(self):
-        self.do_GET(body=False)
+        self.forward(body=False)
 
-    def do_GET(self, body=True):
+    def forward(self, body=True):
+        # every verb goes through here; inside an intercepted CONNECT tunnel the
+        # request line only holds the path
         sent = False
+        start = time.time()
+        request_tap = BodyTap(self.server.capture_body_limit)
+        response_tap = BodyTap(self.server.capture_body_limit)
+        record = {
+            "time": start,
+            "method": self.command,
+            "request_headers": list(self.headers.items()),
+        }
         try:
-            req = None
             resp = None
-            sio = io.StringIO()
             try:
-                hostname = self.headers.get("Host")
-                if not hostname:
-                    hostname = "localhost"
-                url = self.path
-                req = urllib.request.Request(url=url)
-                sio.write("====BEGIN REQUEST=====\n")
-                sio.write(url)
-                sio.write("\n")
-                sio.write(self.command)
-                sio.write(" ")
-                sio.write(self.path)
-                sio.write(" ")
-                sio.write(self.request_version)
-                sio.write("\n")
-                for line in self.headers:
-                    key = line
+                if "://" in self.path:
+                    url = self.path
+                elif self.tunnel_origin:
+                    url = self.tunnel_origin + self.path
+                else:
+                    url = "http://{}{}".format(
+                        self.headers.get("Host", "localhost"), self.path
+                    )
+                record["url"] = url
+                headers = []
+                for key in self.headers:
                     value = self.headers.get(key)
-
-                    line_parts = [key, value]
-                    if len(line_parts) == 2:
-                        if line_parts[0].startswith("X-"):
-                            pass
-                        elif line_parts[0] in ("Connection", "User-Agent"):
-                            pass
-                        else:
-                            sio.write(line)
-                            req.add_header(key=key, val=value)
-                sio.write("\n")
-                sio.write("====END REQUEST=======\n")
-                logger.error(sio.getvalue() + "\n")
-                try:
-                    cookie_jar = http.cookiejar.CookieJar()
-                    cookie_processor = urllib.request.HTTPCookieProcessor(cookie_jar)
-                    opener = urllib.request.build_opener(cookie_processor)
-                    resp = opener.open(req)
-                except urllib.error.HTTPError as e:
-                    if e.getcode():
-                        resp = e
+                    if key.startswith("X-"):
+                        pass
+                    elif key in ("Connection", "User-Agent"):
+                        pass
                     else:
-                        self.send_error(599, "error proxying: {}".format(str(e)))
-                        sent = True
-                        return
-                self.send_response(resp.getcode())
-                headers = resp.getheaders()
-                for header in headers:
-                    name, value = header
-                    self.send_header(keyword=name, value=value)
-                # cookie?
-                for cookie in cookie_jar:
-                    try:
-                        c = http.cookies.SimpleCookie()
-                        c[cookie.name] = cookie.value
-                        for attr in ["path", "expires", "secure"]:
-                            value = getattr(cookie, attr, None)
-                            if value is not None:
-                                c[cookie.name][attr] = value
-                        header = c.output(header="").lstrip()
-                        print(header)
-                        self.send_header("Set-Cookie", header)
-                    except AttributeError as e:
-                        print("WE GOT A COOKIE ERROR GET")
-                        print(cookie)
-                        print(e)
-                self.end_headers()
+                        headers.append((key, value))
+
+                content_length = int(self.headers.get("Content-Length", 0))
+                chunked = "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+                request_body = None
+                if chunked:
+                    request_body = read_chunked(self.rfile, request_tap)
+                elif content_length > buffered_body_limit:
+                    request_body = BodyReader(self.rfile, content_length, request_tap)
+                elif content_length > 0:
+                    # Read the request body from the socket
+                    request_body = request_tap.update(self.rfile.read(content_length))
+                if request_body is not None:
+                    headers.append(("pragma", "no-cache"))
+                self.server.sessions.observe_request(url, self.headers.get("Cookie"))
+
+                resp = self.server.upstream.request(
+                    self.command, url, headers, request_body, chunked
+                )
+                record["status"] = resp.status
+                record["response_headers"] = resp.getheaders()
+                self.server.sessions.observe_response(url, resp.getheaders())
+                record["ttfb"] = time.time() - start
                 sent = True
-                if body:
-                    self.wfile.write(resp.read())
-                return
+                self.send_upstream_response(resp, body, response_tap)
             finally:
                 if resp:
-                    resp.close()
-                sio.close()
-        except IOError as e:
+                    self.server.upstream.release(resp)
+        except (IOError, ValueError, http.client.HTTPException) as e:
+            record["error"] = str(e) or repr(e)
+            # whatever is left of the request or response can't be framed anymore
+            self.close_connection = True
             if not sent:
-                self.send_error(404, "error trying to proxy: {}".format(str(e)))
+                if isinstance(e, (ValueError, http.client.InvalidURL)):
+                    # a bad url, Content-Length or chunk size from the client
+                    code = 400
+                elif isinstance(e, http.client.HTTPException):
+                    code = 502
+                else:
+                    code = 404
+                self.send_error(code, "error trying to proxy: {}".format(e))
 
-    def do_POST(self, body=True):
-        sent = False
+        if self.server.capture:
+            record["total_time"] = time.time() - start
+            record.update(request_tap.fields("request"))
+            record.update(response_tap.fields("response"))
+            self.server.capture.record(record)
+
+    do_GET = forward
+    do_POST = forward
+    do_PUT = forward
+    do_PATCH = forward
+    do_DELETE = forward
+    do_OPTIONS = forward
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(":")
+        if not host or not port.isdigit():
+            self.send_error(400, "bad CONNECT target: {}".format(self.path))
+            return
+        port = int(port)
+
+        authority = self.server.authority
+        if authority and host in self.server.intercept_hosts:
+            self.intercept(host, port, authority)
+        else:
+            self.tunnel(host, port)
+        self.close_connection = True
+
+    def tunnel(self, host, port):
+        # pass the encrypted bytes through untouched
         try:
-            req = None
-            resp = None
-            sio = io.StringIO()
-            try:
-                hostname = self.headers.get("Host")
-                if not hostname:
-                    hostname = "localhost"
-                url = "http://{}".format(hostname)
-                url = self.path
-                req = urllib.request.Request(url=url, method="POST")
-                sio.write("====BEGIN REQUEST=====\n")
-                sio.write(url)
-                sio.write("\n")
-                sio.write(self.command)
-                sio.write(" ")
-                sio.write(self.path)
-                sio.write(" ")
-                sio.write(self.request_version)
-                sio.write("\n")
-                for line in self.headers:
-                    key = line
-                    value = self.headers.get(key)
-                    line_parts = [key, value]
-                    if len(line_parts) == 2:
-                        if line_parts[0].startswith("X-"):
-                            pass
-                        elif line_parts[0] in ("Connection", "User-Agent"):
-                            pass
-                        else:
-                            sio.write(f"{key}={value}")
-                            sio.write("\n")
-                            req.add_header(key=key, val=value)
-                req.add_header(key="pragma", val="no-cache")
-                content_length = int(self.headers.get("Content-Length", 0))
-                # Read the request body from the socket
-                request_body = self.rfile.read(content_length)
-                sio.write(request_body.decode("utf-8"))
-                sio.write("\n")
-                sio.write("====END REQUEST=======\n")
-                logger.error(sio.getvalue() + "\n")
-                logger.error("No real error\n")
-                try:
-                    cookie_jar = http.cookiejar.CookieJar()
-                    cookie_processor = urllib.request.HTTPCookieProcessor(cookie_jar)
-                    opener = urllib.request.build_opener(cookie_processor)
-                    resp = opener.open(req, request_body)
-                except urllib.error.HTTPError as e:
-                    if e.getcode():
-                        resp = e
-                    else:
-                        self.send_error(599, "error proxying: {}".format(str(e)))
-                        sent = True
+            upstream = socket.create_connection((host, port), timeout=30)
+        except OSError as e:
+            self.send_error(502, "error connecting to {}: {}".format(self.path, e))
+            return
+        self.send_response(200, "Connection Established")
+        self.end_headers()
+
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 60)
+                if errored or not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(stream_chunk_size)
+                    if not data:
                         return
-                self.send_response(resp.getcode())
-                headers = resp.getheaders()
-                for header in headers:
-                    name, value = header
-                    self.send_header(keyword=name, value=value)
-                # cookie?
-                for cookie in cookie_jar:
-                    try:
-                        c = http.cookies.SimpleCookie()
-                        c[cookie.name] = cookie.value
-                        for attr in ["domain", "path", "expires", "secure"]:
-                            value = getattr(cookie, attr, None)
-                            if value is not None:
-                                c[cookie.name][attr] = value
-                        header = c.output(header="").lstrip()
-                        print(header)
-                        self.send_header("Set-Cookie", header)
-                    except AttributeError as e:
-                        print("WE GOT A COOKIE ERROR POST")
-                        print(cookie)
-                        print(e)
-                self.end_headers()
-                sent = True
-                if body:
-                    self.wfile.write(resp.read())
-                return
-            finally:
-                if resp:
-                    resp.close()
-                sio.close()
-        except IOError as e:
-            if not sent:
-                self.send_error(404, "error trying to proxy: {}".format(str(e)))
+                    (upstream if sock is self.connection else self.connection).sendall(
+                        data
+                    )
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+
+    def intercept(self, host, port, authority):
+        # terminate TLS with a certificate for host signed by our CA and proxy the
+        # requests inside like any other, so in-scope HTTPS shows up in the log
+        self.send_response(200, "Connection Established")
+        self.end_headers()
+        try:
+            connection = authority.context_for(host).wrap_socket(
+                self.connection, server_side=True
+            )
+        except (ssl.SSLError, OSError) as e:
+            logger.error("TLS handshake for {} failed: {}".format(host, e))
+            return
+
+        self.connection = connection
+        self.rfile = connection.makefile("rb", self.rbufsize)
+        self.wfile = connection.makefile("wb")
+        self.tunnel_origin = "https://{}".format(
+            host if port == 443 else "{}:{}".format(host, port)
+        )
+        self.close_connection = False
+        while not self.close_connection:
+            self.handle_one_request()
+        connection.close()
+
+
+class SingleProxyHTTPRequestHandler(ProxyHTTPRequestHandler):
+    # one connection at a time, so it can't be kept open for the next request
+    protocol_version = "HTTP/1.0"
+
+
+class CertificateAuthority:
+    """
+    Signs a certificate per intercepted host with a local CA using the openssl
+    command line. Create the CA once with
+
+        openssl req -x509 -new -nodes -newkey rsa:2048 -days 3650 \\
+            -subj "/CN=phreakbot CA" -keyout ca.key -out ca.crt
+
+    and trust ca.crt in the browser.
+    """
+
+    def __init__(self, ca_cert, ca_key, cert_dir=".phreakbot_certs"):
+        self.ca_cert = ca_cert
+        self.ca_key = ca_key
+        self.cert_dir = cert_dir
+        self.contexts = {}
+        self.lock = threading.Lock()
+        os.makedirs(cert_dir, exist_ok=True)
+
+    def context_for(self, host):
+        with self.lock:
+            context = self.contexts.get(host)
+            if context is None:
+                cert, key = self.issue(host)
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                context.load_cert_chain(cert, key)
+                self.contexts[host] = context
+            return context
+
+    def issue(self, host):
+        cert = os.path.join(self.cert_dir, host + ".crt")
+        key = os.path.join(self.cert_dir, host + ".key")
+        if os.path.exists(cert) and os.path.exists(key):
+            return cert, key
+
+        csr = os.path.join(self.cert_dir, host + ".csr")
+        ext = os.path.join(self.cert_dir, host + ".ext")
+        try:
+            ipaddress.ip_address(host)
+            san = "IP:" + host
+        except ValueError:
+            san = "DNS:" + host
+        with open(ext, "w") as f:
+            f.write("subjectAltName={}\n".format(san))
+
+        subprocess.run(
+            ["openssl", "req", "-new", "-nodes", "-newkey", "rsa:2048"]
+            + ["-subj", "/CN=" + host, "-keyout", key, "-out", csr],
+            check=True,
+            capture_output=True,
+        )
+        subprocess.run(
+            ["openssl", "x509", "-req", "-in", csr, "-CA", self.ca_cert]
+            + ["-CAkey", self.ca_key, "-CAcreateserial", "-days", "825"]
+            + ["-extfile", ext, "-out", cert],
+            check=True,
+            capture_output=True,
+        )
+        return cert, key
 
 
 def parse_args(argv=sys.argv[1:]):
@@ -229,17 +443,105 @@ def parse_args(argv=sys.argv[1:]):
         default=8181,
         help="serve HTTP requests on specified port (default: random)",
     )
+    parser.add_argument(
+        "--mode",
+        dest="mode",
+        choices=["threaded", "single"],
+        default="threaded",
+        help="serve requests on a thread each or one at a time (default: threaded)",
+    )
+    parser.add_argument(
+        "--capture",
+        dest="capture",
+        default="capture.jsonl",
+        help="append a JSON record of every exchange to this file (default: capture.jsonl)",
+    )
+    parser.add_argument(
+        "--no-capture",
+        dest="capture",
+        action="store_const",
+        const=None,
+        help="don't record traffic",
+    )
+    parser.add_argument(
+        "--capture-body-limit",
+        dest="capture_body_limit",
+        type=int,
+        default=64 * 1024,
+        help="bytes of each body kept in the capture, the rest is only hashed (default: 65536)",
+    )
+    parser.add_argument(
+        "--sessions",
+        dest="sessions",
+        default="sessions.txt",
+        help="cookie jar shared by all requests and saved for the fuzzer (default: sessions.txt)",
+    )
+    parser.add_argument(
+        "--ca-cert",
+        dest="ca_cert",
+        help="CA certificate used to sign certificates for intercepted hosts",
+    )
+    parser.add_argument(
+        "--ca-key",
+        dest="ca_key",
+        help="private key of --ca-cert",
+    )
+    parser.add_argument(
+        "--intercept",
+        dest="intercept_hosts",
+        action="append",
+        default=[],
+        help="decrypt CONNECT tunnels to this host with the local CA, may be repeated; other hosts are tunnelled blind",
+    )
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        type=int,
+        default=8,
+        help="idle keep-alive connections kept per upstream host (default: 8)",
+    )
     args = parser.parse_args(argv)
     return args
 
 
+def make_server(args):
+    # the proxy server for parsed proxy.py arguments, ready for serve_forever
+    server_address = ("127.0.0.1", args.port)
+    if args.mode == "threaded":
+        httpd = ThreadingHTTPServer(server_address, ProxyHTTPRequestHandler)
+    else:
+        httpd = HTTPServer(server_address, SingleProxyHTTPRequestHandler)
+    httpd.upstream = UpstreamPool(max_idle=args.pool_size)
+    httpd.capture = TrafficCapture(args.capture) if args.capture else None
+    httpd.capture_body_limit = args.capture_body_limit
+    httpd.sessions = SessionStore(args.sessions)
+    httpd.authority = None
+    httpd.intercept_hosts = set(args.intercept_hosts)
+    if args.intercept_hosts:
+        if not (args.ca_cert and args.ca_key):
+            sys.exit("--intercept needs --ca-cert and --ca-key")
+        httpd.authority = CertificateAuthority(args.ca_cert, args.ca_key)
+    return httpd
+
+
+def close_server(httpd):
+    httpd.server_close()
+    httpd.sessions.save()
+    if httpd.capture:
+        httpd.capture.close()
+
+
 def main(argv=sys.argv[1:]):
     args = parse_args(argv)
     print(("http server is starting on port {}...".format(args.port)))
-    server_address = ("127.0.0.1", args.port)
-    httpd = HTTPServer(server_address, ProxyHTTPRequestHandler)
+    httpd = make_server(args)
     print("http server is running as proxy")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_server(httpd)
 
 
 if __name__ == "__main__":
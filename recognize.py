@@ -0,0 +1,197 @@
+#
+# recognize.py
+#
+# Decides which fuzz results are worth showing to GPT. Every result first goes
+# through local detectors (payload reflected back, database errors, status,
+# length and timing changes against the unfuzzed response) and only results
+# that trip one are sent on, a few per prompt and cut down to the part of the
+# response around the evidence.
+#
+
+import re
+
+from langchain import PromptTemplate
+
+from llm_cache import acomplete, complete, default_cache
+
+sql_error_signatures = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in [
+        r"you have an error in your sql syntax",
+        r"warning: mysqli?_",
+        r"mysql_fetch_\w+\(",
+        r"supplied argument is not a valid mysql",
+        r"unclosed quotation mark after the character string",
+        r"microsoft ole db provider for (sql server|odbc)",
+        r"\bORA-\d{5}\b",
+        r"pg_(query|exec)\(\)",
+        r"postgresql.{0,40}error",
+        r"syntax error at or near",
+        r"sqlite3?::|sqlite_error|unrecognized token:",
+        r"SQLSTATE\[",
+        r"quoted string not properly terminated",
+    ]
+]
+
+batch_template = """
+You are a proxy checking http responses for vulnerabilities. The technology stack of the target application is:
+{tech_stack}
+
+Each finding below is a payload sent in a parameter, the checks it tripped compared to the response without the payload, and an excerpt of the response.
+
+{findings}
+
+For every finding answer on its own line with its number, VULNERABLE or NOT VULNERABLE, and a short reason. For example:
+1: VULNERABLE - the database error shows the quote broke out of the query
+2: NOT VULNERABLE - the payload is html escaped
+"""
+
+batch_prompt = PromptTemplate(
+    input_variables=["tech_stack", "findings"],
+    template=batch_template,
+)
+
+verdict_re = re.compile(
+    r"^\s*(\d+)\s*[:.)]\s*(NOT VULNERABLE|VULNERABLE)\W*(.*)$", re.I
+)
+
+
+def line_at(body, offset):
+    start = body.rfind("\n", 0, offset) + 1
+    end = body.find("\n", offset)
+    return body[start : end if end != -1 else len(body)]
+
+
+def detect(result, baseline):
+    """
+    The local checks result trips compared to baseline, a baseline.Baseline
+    of the request without a payload, as a list of (name, offset into the
+    body or None).
+    """
+    signals = []
+    if result.get("error"):
+        return signals
+    body = result["body"]
+    payload = result.get("payload") or ""
+
+    # evidence only counts on a line the unfuzzed responses never had
+    offset = body.find(payload) if len(payload) > 2 else -1
+    if offset != -1 and not baseline.knows_line(line_at(body, offset)):
+        signals.append(("reflected", offset))
+
+    for signature in sql_error_signatures:
+        match = signature.search(body)
+        if match and not baseline.knows_line(line_at(body, match.start())):
+            signals.append(("sql error", match.start()))
+            break
+
+    _, reasons = baseline.compare(result)
+    signals.extend((reason, None) for reason in reasons)
+    return signals
+
+
+def excerpt(body, signals, size=600):
+    # the part of the body around the first piece of evidence, or its start
+    offsets = [offset for _, offset in signals if offset is not None]
+    start = max(0, min(offsets) - size // 3) if offsets else 0
+    text = body[start : start + size]
+    return ("..." if start else "") + text + ("..." if start + size < len(body) else "")
+
+
+class Recognizer:
+    """
+    Collects the fuzz results that trip a detector and asks GPT about them
+    batch_size at a time, so the number of completions follows the number of
+    candidates rather than the number of requests sent.
+    """
+
+    def __init__(self, tech_stack, batch_size=5, excerpt_size=600, cache=default_cache):
+        self.tech_stack = tech_stack
+        self.batch_size = batch_size
+        self.excerpt_size = excerpt_size
+        self.cache = cache
+        self.candidates = []
+        self.checked = 0
+
+    def examine(self, result, baseline):
+        # the candidate for result, with only what GPT needs of it, or None
+        signals = detect(result, baseline)
+        if not signals:
+            return None
+        return {
+            "url": result["url"],
+            "parameter": result["parameter"],
+            "payload": result["payload"],
+            "status": result["status"],
+            "signals": [name for name, _ in signals],
+            "excerpt": excerpt(result["body"], signals, self.excerpt_size),
+        }
+
+    def observe(self, result, baseline):
+        # usable as FuzzEngine.run's on_result, collects candidates for recognize
+        self.checked += 1
+        candidate = self.examine(result, baseline)
+        if candidate:
+            self.candidates.append(candidate)
+        return candidate
+
+    def batch_request(self, batch):
+        findings = "\n\n".join(
+            "FINDING {}:\nparameter: {}\npayload: {}\nchecks: {}\nresponse excerpt:\n{}".format(
+                number,
+                candidate["parameter"],
+                candidate["payload"],
+                ", ".join(candidate["signals"]),
+                candidate["excerpt"],
+            )
+            for number, candidate in enumerate(batch, 1)
+        )
+        return dict(
+            model="text-davinci-002",
+            prompt=batch_prompt.format(tech_stack=self.tech_stack, findings=findings),
+            temperature=0,
+            max_tokens=40 * len(batch) + 20,
+        )
+
+    def judge(self, batch, texts):
+        verdicts = parse_verdicts(texts[0] if texts else "")
+        findings = []
+        for number, candidate in enumerate(batch, 1):
+            vulnerable, reason = verdicts.get(number, (None, ""))
+            findings.append(dict(candidate, vulnerable=vulnerable, reason=reason))
+        return findings
+
+    def batches(self, candidates=None):
+        if candidates is None:
+            candidates, self.candidates = self.candidates, []
+        for i in range(0, len(candidates), self.batch_size):
+            yield candidates[i : i + self.batch_size]
+
+    def recognize(self, candidates=None):
+        """
+        Ask GPT about candidates, by default the ones observe collected so
+        far, and return them with a "vulnerable" verdict and GPT's "reason"
+        added.
+        """
+        findings = []
+        for batch in self.batches(candidates):
+            texts = complete(self.batch_request(batch), self.cache)
+            findings += self.judge(batch, texts)
+        return findings
+
+    async def arecognize(self, candidates=None):
+        findings = []
+        for batch in self.batches(candidates):
+            texts = await acomplete(self.batch_request(batch), self.cache)
+            findings += self.judge(batch, texts)
+        return findings
+
+
+def parse_verdicts(text):
+    verdicts = {}
+    for line in text.splitlines():
+        match = verdict_re.match(line)
+        if match:
+            number, verdict, reason = match.groups()
+            verdicts[int(number)] = (verdict.upper() == "VULNERABLE", reason.strip())
+    return verdicts
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# scheduler.py
+#
+# Scans many targets at once. Every target gets a pipeline.py scan in its own
+# worker process, with its own browser, proxy port, capture, cookie jar and
+# log under the output directory, and the pool is as big as the machine has
+# cores. The GPT cache and payload corpus are shared, so what one scan learns
+# the others get for free.
+#
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import openai
+
+import pipeline
+
+
+def read_targets(path):
+    # one "url [username:password]" per line, # starts a comment
+    targets = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                targets.append(line)
+    return targets
+
+
+def target_dir(out, index, url):
+    # the index keeps the same url listed with other credentials apart
+    parts = urlsplit(url if "://" in url else "http://" + url)
+    name = re.sub(
+        r"[^A-Za-z0-9.-]+", "_", "_".join([parts.scheme, parts.netloc + parts.path])
+    ).strip("_")
+    return os.path.join(out, "{}_{}".format(index, name))
+
+
+def scan_target(argv, log):
+    """
+    Run pipeline.scan for pipeline.py arguments argv with its output going to
+    log. Runs in a worker process and returns the scan's summary, or the
+    error that ended it.
+    """
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    args = pipeline.parse_args(argv)
+    with open(log, "a") as f:
+        with contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+            try:
+                return pipeline.scan(args)
+            except Exception as e:
+                print("scan failed: {!r}".format(e))
+                return {"domain": args.domain, "error": repr(e), "findings": []}
+
+
+def pipeline_argv(args, index, target):
+    url, _, credentials = target.partition(" ")
+    directory = target_dir(args.out, index, url)
+    port = args.base_port + index
+    os.makedirs(directory, exist_ok=True)
+    argv = [
+        "--domain",
+        url,
+        "--port",
+        str(port),
+        "--capture",
+        os.path.join(directory, "capture.jsonl"),
+        "--sessions",
+        os.path.join(directory, "sessions.txt"),
+        "--findings",
+        os.path.join(directory, "findings.jsonl"),
+        "--pages",
+        str(args.pages),
+        "--steps",
+        str(args.steps),
+        "--fuzzers",
+        str(args.fuzzers),
+        "--tech-stack",
+        args.tech_stack,
+    ]
+    if credentials.strip():
+        argv += ["--credentials", credentials.strip()]
+    for attack in args.attacks or []:
+        argv += ["--attack", attack]
+    if args.rate:
+        argv += ["--rate", str(args.rate)]
+    return argv, os.path.join(directory, "scan.log")
+
+
+def parse_args(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Scan several targets in parallel, one worker process each"
+    )
+    parser.add_argument(
+        "--targets",
+        dest="targets_file",
+        help='file with one "url [username:password]" per line',
+    )
+    parser.add_argument(
+        "--target",
+        dest="targets",
+        action="append",
+        default=[],
+        help='"url [username:password]" to scan, may be repeated',
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=os.cpu_count(),
+        help="targets scanned at once (default: one per core)",
+    )
+    parser.add_argument(
+        "--base-port",
+        dest="base_port",
+        type=int,
+        default=8200,
+        help="the proxy for the nth target listens on base port + n (default: 8200)",
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        default="scans",
+        help="directory for each target's capture, cookies, findings and log (default: scans)",
+    )
+    parser.add_argument("--pages", dest="pages", type=int, default=2)
+    parser.add_argument("--steps", dest="steps", type=int, default=10)
+    parser.add_argument("--fuzzers", dest="fuzzers", type=int, default=4)
+    parser.add_argument(
+        "--attack",
+        dest="attacks",
+        action="append",
+        help="target attack, may be repeated (default: sql injection and reflected-xss)",
+    )
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        type=float,
+        help="requests per second per target (default: no limit)",
+    )
+    parser.add_argument("--tech-stack", dest="tech_stack", default="unknown")
+    args = parser.parse_args(argv)
+    if args.targets_file:
+        args.targets += read_targets(args.targets_file)
+    if not args.targets:
+        parser.error("no targets, use --target or --targets")
+    return args
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    os.makedirs(args.out, exist_ok=True)
+    start = time.time()
+    summaries = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for i, target in enumerate(args.targets):
+            scan_argv, log = pipeline_argv(args, i, target)
+            futures[pool.submit(scan_target, scan_argv, log)] = target
+            print("queued {} (log: {})".format(target, log))
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            print(
+                "{domain}: {status}".format(
+                    domain=summary["domain"],
+                    status=summary.get("error")
+                    or "{} findings, {} points fuzzed in {:0.1f} seconds".format(
+                        len(summary["findings"]), summary["fuzzed"], summary["seconds"]
+                    ),
+                )
+            )
+
+    elapsed = time.time() - start
+    with open(os.path.join(args.out, "summary.json"), "w") as f:
+        json.dump({"seconds": elapsed, "scans": summaries}, f, indent=2)
+    print(
+        "Scanned {} targets in {:0.1f} seconds, {} findings in total".format(
+            len(summaries), elapsed, sum(len(s["findings"]) for s in summaries)
+        )
+    )
+    for summary in summaries:
+        for finding in summary["findings"]:
+            print(
+                "{domain} {attack} {route} {location} {parameter}: {payload!r}".format(
+                    domain=summary["domain"], **finding
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#
+# sessions.py
+#
+# One cookie jar per proxy, shared by every request instead of a fresh
+# CookieJar each time. The proxy feeds it the cookies the browser sends and the
+# Set-Cookie headers targets answer with, and saves it to disk so the fuzzer
+# can replay requests with the logged in session (DVWA's PHPSESSID and
+# security cookie, say) without going through the browser.
+#
+
+import http.client
+import http.cookiejar
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+class HeadersResponse:
+    # the bit of a urllib response CookieJar.extract_cookies looks at
+    def __init__(self, headers):
+        self.headers = http.client.HTTPMessage()
+        for name, value in headers:
+            self.headers[name] = value
+
+    def info(self):
+        return self.headers
+
+
+class SessionStore:
+    def __init__(self, path="sessions.txt", autosave=True):
+        # autosave writes changes to path once a second from a background thread;
+        # readers such as the fuzzer pass autosave=False and pick up changes on use
+        self.path = path
+        self.jar = http.cookiejar.LWPCookieJar(path)
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.loaded_mtime = None
+        self.reload()
+        if autosave:
+            threading.Thread(target=self.autosave, daemon=True).start()
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        with self.lock:
+            if mtime != self.loaded_mtime:
+                self.jar.load(ignore_discard=True)
+                self.loaded_mtime = mtime
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            # session cookies like PHPSESSID are exactly the ones we need to keep
+            tmp = self.path + ".tmp"
+            self.jar.save(tmp, ignore_discard=True)
+            os.replace(tmp, self.path)
+            self.loaded_mtime = os.path.getmtime(self.path)
+            self.dirty = False
+
+    def autosave(self):
+        while True:
+            time.sleep(1)
+            self.save()
+
+    def observe_response(self, url, headers):
+        if not any(
+            name.lower() in ("set-cookie", "set-cookie2") for name, _ in headers
+        ):
+            return
+        with self.lock:
+            self.jar.extract_cookies(
+                HeadersResponse(headers), urllib.request.Request(url)
+            )
+            self.dirty = True
+
+    def observe_request(self, url, cookie_header):
+        # the browser is the authority on its cookies, including ones set from javascript
+        if not cookie_header:
+            return
+        request = urllib.request.Request(url)
+        with self.lock:
+            for name, value in parse_cookie_header(cookie_header).items():
+                cookie = self.find(request, name)
+                if cookie is None:
+                    self.jar.set_cookie(make_cookie(request, name, value))
+                elif cookie.value != value:
+                    cookie.value = value
+                else:
+                    continue
+                self.dirty = True
+
+    def find(self, request, name):
+        _, domain = http.cookiejar.eff_request_host(request)
+        path = urllib.parse.urlsplit(request.full_url).path or "/"
+        for cookie in self.jar:
+            if (
+                cookie.name == name
+                and http.cookiejar.domain_match(domain, cookie.domain.lstrip("."))
+                and path.startswith(cookie.path)
+                and not cookie.is_expired()
+            ):
+                return cookie
+        return None
+
+    def cookie_header(self, url):
+        # the Cookie header to send with a request to url, or None
+        self.reload()
+        request = urllib.request.Request(url)
+        with self.lock:
+            self.jar.add_cookie_header(request)
+        return request.get_header("Cookie")
+
+    def cookies(self, url):
+        return parse_cookie_header(self.cookie_header(url))
+
+
+def parse_cookie_header(cookie_header):
+    cookies = {}
+    for pair in (cookie_header or "").split(";"):
+        name, sep, value = pair.strip().partition("=")
+        if sep:
+            cookies[name] = value
+    return cookies
+
+
+def make_cookie(request, name, value):
+    _, domain = http.cookiejar.eff_request_host(request)
+    return http.cookiejar.Cookie(
+        version=0,
+        name=name,
+        value=value,
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=False,
+        domain_initial_dot=False,
+        path="/",
+        path_specified=False,
+        secure=False,
+        expires=None,
+        discard=True,
+        comment=None,
+        comment_url=None,
+        rest={},
+    )
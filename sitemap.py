@@ -0,0 +1,195 @@
+#
+# sitemap.py
+#
+# What the agent has already seen and done. Pages are keyed by their url
+# without query values, states by the page plus a fingerprint of the element
+# structure Crawler.crawl renders, and every page remembers the links, buttons
+# and inputs GPT has acted on. Explored states can be skipped without asking
+# GPT, and the prompt gets a short list of what hasn't been tried yet.
+#
+
+import hashlib
+import re
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+from commands import parse_commands
+from compact import compact_url, element_re, element_scores
+
+actionable_tags = set(["link", "button", "input", "textarea"])
+id_re = re.compile(r" id=\d+")
+
+
+def normalize_url(url):
+    # /index.php?page=2 and /index.php?page=3 are the same page, a new query key is not
+    parts = urlsplit(url)
+    keys = sorted(set(key for key, _ in parse_qsl(parts.query, True)))
+    query = "&".join(keys)
+    return urlunsplit(
+        (parts.scheme, parts.netloc.lower(), parts.path or "/", query, "")
+    )
+
+
+def element_key(element):
+    # an element without its id, which changes from one crawl to the next
+    return id_re.sub("", element, count=1)
+
+
+def element_keys(elements):
+    """
+    element -> key for the elements of one crawl. Elements that render the
+    same (new password and confirm password) are told apart by how many came
+    before them.
+    """
+    keys = {}
+    counts = {}
+    for element in elements:
+        key = element_key(element)
+        n = counts.get(key, 0)
+        counts[key] = n + 1
+        keys[element] = key if n == 0 else "{} #{}".format(key, n + 1)
+    return keys
+
+
+def element_tag(element):
+    match = element_re.match(element)
+    return match.group(1) if match else "text"
+
+
+def structure_fingerprint(elements):
+    # tags and attributes only, so text that changes on every load (dates, csrf
+    # tokens, counters) doesn't make a new state
+    structure = []
+    for element in elements:
+        match = element_re.match(element)
+        if match and match.group(1) != "text":
+            structure.append(match.group(1) + match.group(3))
+    return hashlib.sha1("\n".join(structure).encode("utf-8")).hexdigest()[:16]
+
+
+def command_targets(cmd, elements):
+    # the elements the lines of cmd click or type into
+    by_id = {}
+    for element in elements:
+        match = element_re.match(element)
+        if match:
+            by_id[int(match.group(2))] = element
+    commands, _ = parse_commands(cmd)
+    ids = [getattr(command, "id", None) for command in commands]
+    return [by_id[id] for id in ids if id in by_id]
+
+
+class Page:
+    def __init__(self, url):
+        self.url = url
+        self.states = {}
+        self.actionable = {}
+        self.acted = set()
+        self.has_form = False
+
+    def unexplored(self):
+        return [
+            element for key, element in self.actionable.items() if key not in self.acted
+        ]
+
+
+class ExplorationGraph:
+    def __init__(self):
+        self.pages = {}
+        self.edges = {}
+
+    def observe(self, url, elements, previous=None, command=None):
+        """
+        Record the state the page at url is in, given the elements crawl
+        returned for it, and the command that led here from state previous.
+        Returns the state, a (page url, fingerprint) pair.
+        """
+        page_url = normalize_url(url)
+        page = self.pages.get(page_url)
+        if page is None:
+            page = self.pages[page_url] = Page(url)
+        state = (page_url, structure_fingerprint(elements))
+        page.states[state[1]] = page.states.get(state[1], 0) + 1
+
+        keys = element_keys(elements)
+        for element in elements:
+            tag = element_tag(element)
+            if tag in actionable_tags:
+                page.actionable[keys[element]] = element
+            if tag in ("input", "textarea"):
+                page.has_form = True
+
+        if previous is not None and command:
+            self.edges.setdefault(previous, {})[command] = state
+        return state
+
+    def record(self, state, command, elements):
+        # marks the elements command acts on as explored
+        page = self.pages[state[0]]
+        keys = element_keys(elements)
+        for element in command_targets(command, elements):
+            page.acted.add(keys[element])
+
+    def visits(self, state):
+        return self.pages[state[0]].states.get(state[1], 0)
+
+    def exhausted(self, state):
+        # seen before and every link, button and input on the page has been tried
+        page = self.pages[state[0]]
+        return self.visits(state) > 1 and not page.unexplored()
+
+    def frontier(self, exclude=None):
+        # the url of the page with the most left to try
+        pages = [
+            page
+            for page_url, page in self.pages.items()
+            if page_url != exclude and page.unexplored()
+        ]
+        if not pages:
+            return None
+        return max(pages, key=lambda page: len(page.unexplored())).url
+
+    def prefer_unexplored(self, commands, state, elements):
+        # commands acting on something new first, the rest keep their order
+        page = self.pages[state[0]]
+        keys = element_keys(elements)
+
+        def tried(cmd):
+            targets = command_targets(cmd, elements)
+            return bool(targets) and all(
+                keys[element] in page.acted for element in targets
+            )
+
+        return sorted(commands, key=tried)
+
+    def unvisited(self, state, elements, limit=8, pages=5):
+        """
+        Compact text for the prompt: elements in view that haven't been acted
+        on, most useful first, and other pages that still have something to try.
+        """
+        page = self.pages[state[0]]
+        keys = element_keys(elements)
+        fresh = [
+            element
+            for element in elements
+            if element_tag(element) in actionable_tags
+            and keys[element] not in page.acted
+        ]
+        fresh.sort(key=lambda element: -element_scores.get(element_tag(element), 1))
+        lines = fresh[:limit]
+
+        others = [
+            compact_url(other.url)
+            for page_url, other in self.pages.items()
+            if page_url != state[0] and other.unexplored()
+        ]
+        if others:
+            lines.append("other pages: " + ", ".join(others[:pages]))
+        return "\n".join(lines) if lines else "nothing new in view"
+
+    def summary(self):
+        return {
+            "pages": len(self.pages),
+            "states": sum(len(page.states) for page in self.pages.values()),
+            "forms": sorted(page.url for page in self.pages.values() if page.has_form),
+            "unexplored": sum(len(page.unexplored()) for page in self.pages.values()),
+        }
@@ -0,0 +1,460 @@
+#
+# snapshot.py
+#
+# Turns a raw DOMSnapshot.captureSnapshot result into the simplified element
+# list the browsing prompt is built from. Kept free of playwright so it can be
+# benchmarked and tested against recorded snapshots.
+#
+
+from sys import platform
+
+black_listed_elements = set(
+    [
+        "html",
+        "head",
+        "title",
+        "meta",
+        "iframe",
+        "body",
+        "script",
+        "style",
+        "path",
+        "svg",
+        "br",
+        "::marker",
+    ]
+)
+
+
+viewport_state_js = """
+() => {
+	const body = document.body;
+	return {
+		devicePixelRatio: window.devicePixelRatio,
+		scrollX: window.scrollX,
+		scrollY: window.scrollY,
+		pageXOffset: window.pageXOffset,
+		pageYOffset: window.pageYOffset,
+		screenWidth: window.screen.width,
+		screenHeight: window.screen.height,
+		offsetHeight: body ? body.offsetHeight : 0,
+		scrollHeight: body ? body.scrollHeight : 0,
+		mutations: window.__phreakbotMutations === undefined ? null : window.__phreakbotMutations,
+		timeOrigin: performance.timeOrigin,
+	};
+}
+"""
+
+
+# installed with page.add_init_script, counts DOM mutations so crawl() can tell when
+# the last snapshot is still good
+dom_watcher_js = """
+(() => {
+	if (window.__phreakbotMutations !== undefined) return;
+	window.__phreakbotMutations = 0;
+	const bump = () => { window.__phreakbotMutations++; };
+	new MutationObserver(bump).observe(document, {
+		childList: true,
+		subtree: true,
+		attributes: true,
+		characterData: true,
+	});
+	// typing into an input changes its value without touching the DOM
+	document.addEventListener("input", bump, true);
+	document.addEventListener("change", bump, true);
+})();
+"""
+
+
+# resolves with the milliseconds waited once dom_watcher_js has counted no mutations
+# for quietMs, or after timeoutMs
+dom_settled_js = """
+([quietMs, timeoutMs]) => new Promise((resolve) => {
+	const start = performance.now();
+	let last = window.__phreakbotMutations;
+	let lastChange = start;
+	const tick = () => {
+		const now = performance.now();
+		if (window.__phreakbotMutations !== last) {
+			last = window.__phreakbotMutations;
+			lastChange = now;
+		}
+		if (now - lastChange >= quietMs || now - start >= timeoutMs) {
+			resolve(now - start);
+		} else {
+			setTimeout(tick, 50);
+		}
+	};
+	setTimeout(tick, 50);
+})
+"""
+
+
+def parse_viewport(state):
+    """
+    Turn the result of evaluating viewport_state_js into window bounds in CSS
+    pixels plus the scroll position as a percentage of the document.
+
+    dom_version changes whenever the DOM or layout may have changed since the
+    last call, it is None when dom_watcher_js is not installed on the page.
+    """
+    device_pixel_ratio = state["devicePixelRatio"]
+    if platform == "darwin" and device_pixel_ratio == 1:  # lies
+        device_pixel_ratio = 2
+
+    win_upper_bound = state["pageYOffset"]
+    win_left_bound = state["pageXOffset"]
+    win_width = state["screenWidth"]
+    win_height = state["screenHeight"]
+    document_scroll_height = state["scrollHeight"]
+
+    if document_scroll_height > 0:
+        percentage_progress_start = (win_upper_bound / document_scroll_height) * 100
+        percentage_progress_end = min(
+            ((win_height + win_upper_bound) / document_scroll_height) * 100, 100
+        )
+    else:
+        percentage_progress_start = 0
+        percentage_progress_end = 100
+
+    # a new document gets a new timeOrigin, layout shifts without mutations show up in the heights
+    dom_version = None
+    if state["mutations"] is not None:
+        dom_version = (
+            state["timeOrigin"],
+            state["mutations"],
+            device_pixel_ratio,
+            state["offsetHeight"],
+            document_scroll_height,
+        )
+
+    return {
+        "device_pixel_ratio": device_pixel_ratio,
+        "dom_version": dom_version,
+        "scroll_x": state["scrollX"],
+        "scroll_y": state["scrollY"],
+        "left": win_left_bound,
+        "top": win_upper_bound,
+        "right": win_left_bound + win_width,
+        "bottom": win_upper_bound + win_height,
+        "offset_height": state["offsetHeight"],
+        "scroll_height": document_scroll_height,
+        "scrollbar": "[scrollbar {:0.2f}-{:0.2f}%]".format(
+            percentage_progress_start, percentage_progress_end
+        ),
+    }
+
+
+def convert_name(node_name, has_click_handler):
+    if node_name == "a":
+        return "link"
+    if node_name == "input":
+        return "input"
+    if node_name == "img":
+        return "img"
+    if node_name == "button" or has_click_handler:  # found pages that needed this quirk
+        return "button"
+    else:
+        return "text"
+
+
+def find_attributes(strings, attributes, keys):
+    values = {}
+
+    for [key_index, value_index] in zip(*(iter(attributes),) * 2):
+        if value_index < 0:
+            continue
+        key = strings[key_index]
+        value = strings[value_index]
+
+        if key in keys:
+            values[key] = value
+            keys.remove(key)
+
+            if not keys:
+                return values
+
+    return values
+
+
+def index_layout(layout_node_index):
+    # node index -> position in the layout arrays, first box wins like list.index did
+    layout_cursor = {}
+    for cursor, node_index in enumerate(layout_node_index):
+        layout_cursor.setdefault(node_index, cursor)
+    return layout_cursor
+
+
+def index_input_values(input_value):
+    # node index -> string index of the current value of the input
+    return dict(zip(input_value["index"], input_value["value"]))
+
+
+def compute_ancestry(node_names, parent):
+    """
+    Find the nearest enclosing <a> and <button> of every node.
+
+    node_names are the lowercased node names and parent the parentIndex array
+    of the snapshot. Returns two lists holding the node index of the nearest
+    anchor/button ancestor (a node counts as its own ancestor) or -1.
+    """
+    anchor_ancestor = [-1] * len(node_names)
+    button_ancestor = [-1] * len(node_names)
+
+    # parents always precede their children in a CDP snapshot, so one forward pass is enough
+    for index, node_name in enumerate(node_names):
+        parent_index = parent[index]
+
+        # even if the anchor is nested in another anchor, we set the "root" for all descendants to be ::Self
+        if node_name == "a":
+            anchor_ancestor[index] = index
+        elif parent_index >= 0:
+            anchor_ancestor[index] = anchor_ancestor[parent_index]
+
+        if node_name == "button":
+            button_ancestor[index] = index
+        elif parent_index >= 0:
+            button_ancestor[index] = button_ancestor[parent_index]
+
+    return anchor_ancestor, button_ancestor
+
+
+def build_element_table(tree, device_pixel_ratio=1):
+    """
+    Parse a DOMSnapshot.captureSnapshot result into a viewport independent table.
+
+    Every laid out node gets one row holding its bounds in CSS pixels, the text
+    and attributes it contributes to an enclosing link or button, and the
+    element it renders as, if any. render_elements turns the rows that are
+    inside a viewport into prompt text, so the table can be reused while the
+    DOM does not change.
+    """
+    strings = tree["strings"]
+    document = tree["documents"][0]
+    nodes = document["nodes"]
+    backend_node_id = nodes["backendNodeId"]
+    attributes = nodes["attributes"]
+    node_value = nodes["nodeValue"]
+    parent = nodes["parentIndex"]
+    node_names = nodes["nodeName"]
+    is_clickable = set(nodes["isClickable"]["index"])
+
+    input_values = index_input_values(nodes["inputValue"])
+
+    layout = document["layout"]
+    layout_cursor = index_layout(layout["nodeIndex"])
+    bounds = layout["bounds"]
+
+    element_table = []
+
+    lowered_names = [strings[node_name_index].lower() for node_name_index in node_names]
+    anchor_ancestor, button_ancestor = compute_ancestry(lowered_names, parent)
+
+    for index, node_name in enumerate(lowered_names):
+        anchor_id = anchor_ancestor[index]
+        button_id = button_ancestor[index]
+        is_ancestor_of_anchor = anchor_id >= 0
+        is_ancestor_of_button = button_id >= 0
+
+        cursor = layout_cursor.get(index)
+        if cursor is None:
+            continue
+
+        if node_name in black_listed_elements:
+            continue
+
+        [x, y, width, height] = bounds[cursor]
+        x /= device_pixel_ratio
+        y /= device_pixel_ratio
+        width /= device_pixel_ratio
+        height /= device_pixel_ratio
+
+        meta_data = []
+
+        # inefficient to grab the same set of keys for kinds of objects but its fine for now
+        element_attributes = find_attributes(
+            strings,
+            attributes[index],
+            ["type", "placeholder", "aria-label", "title", "alt"],
+        )
+
+        ancestor_exception = is_ancestor_of_anchor or is_ancestor_of_button
+        ancestor_node_key = (
+            None
+            if not ancestor_exception
+            else anchor_id
+            if is_ancestor_of_anchor
+            else button_id
+        )
+        ancestor_node = []
+
+        row = {
+            "bounds": (x, y, x + width, y + height),
+            "ancestor": ancestor_node_key,
+            "children": ancestor_node,
+            "element": None,
+        }
+        element_table.append(row)
+
+        if node_name == "#text" and ancestor_exception:
+            text = strings[node_value[index]]
+            if text == "|" or text == "•":
+                continue
+            ancestor_node.append({"type": "type", "value": text})
+        else:
+            if (
+                node_name == "input" and element_attributes.get("type") == "submit"
+            ) or node_name == "button":
+                node_name = "button"
+                element_attributes.pop("type", None)  # prevent [button ... (button)..]
+
+            for key in element_attributes:
+                if ancestor_exception:
+                    ancestor_node.append(
+                        {
+                            "type": "attribute",
+                            "key": key,
+                            "value": element_attributes[key],
+                        }
+                    )
+                else:
+                    meta_data.append(element_attributes[key])
+
+        element_node_value = None
+
+        if node_value[index] >= 0:
+            element_node_value = strings[node_value[index]]
+            if (
+                element_node_value == "|"
+            ):  # commonly used as a seperator, does not add much context - lets save ourselves some token space
+                continue
+        elif node_name == "input" and index in input_values:
+            text_index = input_values[index]
+            if text_index >= 0:
+                element_node_value = strings[text_index]
+
+        # remove redudant elements
+        if ancestor_exception and (node_name != "a" and node_name != "button"):
+            continue
+
+        row["element"] = {
+            "node_index": index,
+            "backend_node_id": backend_node_id[index],
+            "node_name": node_name,
+            "node_value": element_node_value,
+            "node_meta": meta_data,
+            "is_clickable": index in is_clickable,
+            "origin_x": int(x),
+            "origin_y": int(y),
+            "center_x": int(x + (width / 2)),
+            "center_y": int(y + (height / 2)),
+        }
+
+    return element_table
+
+
+def render_elements(element_table, viewport):
+    """
+    Render the rows of an element table that are partially inside viewport.
+
+    viewport is (left, top, right, bottom) in CSS pixels. Returns the list of
+    simplified elements for the prompt and the id -> element buffer used to
+    act on them.
+    """
+    win_left_bound, win_upper_bound, win_right_bound, win_lower_bound = viewport
+
+    child_nodes = {}
+    elements_in_view_port = []
+
+    for row in element_table:
+        elem_left_bound, elem_top_bound, elem_right_bound, elem_lower_bound = row[
+            "bounds"
+        ]
+
+        partially_is_in_viewport = (
+            elem_left_bound < win_right_bound
+            and elem_right_bound >= win_left_bound
+            and elem_top_bound < win_lower_bound
+            and elem_lower_bound >= win_upper_bound
+        )
+
+        if not partially_is_in_viewport:
+            continue
+
+        if row["children"]:
+            child_nodes.setdefault(row["ancestor"], []).extend(row["children"])
+
+        element = row["element"]
+        if element:
+            # the table is reused across renders, so don't let the merge below touch it
+            element = dict(element)
+            element["node_meta"] = list(element["node_meta"])
+            elements_in_view_port.append(element)
+
+    # lets filter further to remove anything that does not hold any text nor has click handlers + merge text from leaf#text nodes with the parent
+    elements_of_interest = []
+    page_element_buffer = {}
+    id_counter = 0
+
+    for element in elements_in_view_port:
+        node_index = element.get("node_index")
+        node_name = element.get("node_name")
+        node_value = element.get("node_value")
+        is_clickable = element.get("is_clickable")
+        meta_data = element.get("node_meta")
+
+        inner_text = f"{node_value} " if node_value else ""
+        meta = ""
+
+        if node_index in child_nodes:
+            for child in child_nodes.get(node_index):
+                entry_type = child.get("type")
+                entry_value = child.get("value")
+
+                if entry_type == "attribute":
+                    entry_key = child.get("key")
+                    meta_data.append(f'{entry_key}="{entry_value}"')
+                else:
+                    inner_text += f"{entry_value} "
+
+        if meta_data:
+            meta_string = " ".join(meta_data)
+            meta = f" {meta_string}"
+
+        if inner_text != "":
+            inner_text = f"{inner_text.strip()}"
+
+        converted_node_name = convert_name(node_name, is_clickable)
+
+        # not very elegant, more like a placeholder
+        if (
+            (converted_node_name != "button" or meta == "")
+            and converted_node_name != "link"
+            and converted_node_name != "input"
+            and converted_node_name != "img"
+            and converted_node_name != "textarea"
+        ) and inner_text.strip() == "":
+            continue
+
+        page_element_buffer[id_counter] = element
+
+        if inner_text != "":
+            elements_of_interest.append(
+                f"""<{converted_node_name} id={id_counter}{meta}>{inner_text}</{converted_node_name}>"""
+            )
+        else:
+            elements_of_interest.append(
+                f"""<{converted_node_name} id={id_counter}{meta}/>"""
+            )
+        id_counter += 1
+
+    return elements_of_interest, page_element_buffer
+
+
+def parse_snapshot(tree, viewport, device_pixel_ratio=1):
+    """
+    Parse a DOMSnapshot.captureSnapshot result in one go.
+
+    Same as render_elements(build_element_table(tree, device_pixel_ratio), viewport).
+    """
+    return render_elements(build_element_table(tree, device_pixel_ratio), viewport)
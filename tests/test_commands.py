@@ -0,0 +1,75 @@
+import pytest
+
+from commands import (
+    Click,
+    ReturnDomain,
+    Scroll,
+    Type,
+    batch_commands,
+    check_command,
+    format_commands,
+    parse_commands,
+    rank_commands,
+)
+
+
+@pytest.mark.parametrize(
+    "line, command",
+    [
+        ("CLICK 5", Click(5)),
+        ("1. click [5]", Click(5)),
+        ("Click on id=5", Click(5)),
+        ('TYPE 3 "admin"', Type(3, "admin", False)),
+        ("type 3 'admin'", Type(3, "admin", False)),
+        ('TYPESUBMIT 4 "password"', Type(4, "password", True)),
+        ('TYPE 3 ""', Type(3, "", False)),
+        ("SCROLL DOWN", Scroll("down", 1)),
+        ("- scroll_up", Scroll("up", 1)),
+        ("RETURN DOMAIN", ReturnDomain()),
+        ("return to domain", ReturnDomain()),
+    ],
+)
+def test_parse_line(line, command):
+    assert parse_commands(line) == ([command], [])
+
+
+@pytest.mark.parametrize(
+    "line", ["RETURN", "Return to the form", "TYPE 3", "CLICK", "I would click 5"]
+)
+def test_not_a_command(line):
+    assert parse_commands(line) == ([], [(line, "not a command")])
+
+
+def test_round_trip():
+    text = 'CLICK 1\nTYPE 2 "a b"\nTYPESUBMIT 3 "c"\nSCROLL UP\nRETURN DOMAIN'
+    commands, errors = parse_commands(text)
+    assert not errors
+    assert format_commands(commands) == text
+    assert parse_commands(format_commands(commands))[0] == commands
+
+
+def test_batch_commands():
+    commands, _ = parse_commands(
+        "SCROLL DOWN\nSCROLL DOWN\nSCROLL UP\nCLICK 1\nCLICK 1"
+    )
+    assert batch_commands(commands) == [
+        Scroll("down", 2),
+        Scroll("up", 1),
+        Click(1),
+        Click(1),
+    ]
+
+
+def test_check_command():
+    buffer = {1: {}, 2: {}}
+    assert check_command("CLICK 1", buffer) == []
+    assert check_command("CLICK 9", buffer) == ["no element with id 9: CLICK 9"]
+    assert check_command("hello", buffer) == ["no command in 'hello'"]
+
+
+def test_rank_commands():
+    buffer = {1: {}, 2: {}}
+    candidates = ["click [2]", "CLICK 1", "CLICK 2", "CLICK 7", "nothing to do"]
+    commands, rejected = rank_commands(candidates, buffer)
+    assert commands == ["CLICK 2", "CLICK 1"]
+    assert [cmd for cmd, _ in rejected] == ["CLICK 7", "nothing to do"]
@@ -0,0 +1,132 @@
+import json
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+from injection import (
+    InjectionPoints,
+    mutate_request,
+    parameter_value,
+    request_points,
+    route_template,
+)
+
+
+def request(url="http://localhost/vulnerabilities/sqli/", body=b"", headers=()):
+    return {
+        "method": "POST" if body else "GET",
+        "url": url,
+        "headers": list(headers),
+        "body": body,
+    }
+
+
+def test_route_template():
+    assert route_template("/user/12/orders/3f2c9a1b8d7e6f50") == (
+        "/user/{int}/orders/{hex}",
+        [(2, "12"), (4, "3f2c9a1b8d7e6f50")],
+    )
+
+
+def test_query():
+    mutated = mutate_request(
+        request("http://h/?id=1&Submit=Submit"), "id", "1' OR '1'='1"
+    )
+    query = parse_qsl(urlsplit(mutated["url"]).query)
+    assert query == [("id", "1' OR '1'='1"), ("Submit", "Submit")]
+    assert parameter_value(mutated, "id") == "1' OR '1'='1"
+
+
+def test_form():
+    form = request(
+        body=b"username=admin&password=x",
+        headers=[("Content-Type", "application/x-www-form-urlencoded")],
+    )
+    mutated = mutate_request(form, "password", "<script>")
+    assert parse_qsl(mutated["body"].decode()) == [
+        ("username", "admin"),
+        ("password", "<script>"),
+    ]
+
+
+def test_missing_parameter():
+    assert mutate_request(request("http://h/?id=1"), "name", "x") is None
+    assert mutate_request(request("http://h/?id=1"), "id", "x", "json") is None
+
+
+def test_json_paths():
+    document = {"user.name": "bob", "items": [{"id": 1}], "note": None}
+    json_request = request(
+        body=json.dumps(document).encode(),
+        headers=[("Content-Type", "application/json")],
+    )
+    points = [p for p in request_points(json_request) if p[0] == "json"]
+    assert points == [
+        ("json", "user\\.name", "bob"),
+        ("json", "items.0.id", 1),
+        ("json", "note", None),
+    ]
+    for _, path, _ in points:
+        mutated = json.loads(mutate_request(json_request, path, "P", "json")["body"])
+        assert "P" in json.dumps(mutated)
+    mutated = json.loads(
+        mutate_request(json_request, "user\\.name", "P", "json")["body"]
+    )
+    assert mutated == {"user.name": "P", "items": [{"id": 1}], "note": None}
+
+
+def test_multipart():
+    boundary = "----WebKitFormBoundaryAbC"
+    body = (
+        '--{b}\r\nContent-Disposition: form-data; name="title"\r\n\r\nhello\r\n'
+        '--{b}\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+        "Content-Type: text/plain\r\n\r\nfile body\r\n--{b}--\r\n"
+    ).format(b=boundary)
+    upload = request(
+        body=body.encode(),
+        headers=[("Content-Type", "multipart/form-data; boundary=" + boundary)],
+    )
+    assert [p for p in request_points(upload) if p[0] == "multipart"] == [
+        ("multipart", "title", "hello")
+    ]
+    mutated = mutate_request(upload, "title", "<svg>", "multipart")
+    assert b'name="title"\r\n\r\n<svg>\r\n' in mutated["body"]
+    assert b"file body" in mutated["body"]
+
+
+@pytest.mark.parametrize(
+    "location, parameter, check",
+    [
+        (
+            "cookie",
+            "security",
+            lambda m: ("Cookie", "PHPSESSID=abc; security=P") in m["headers"],
+        ),
+        ("header", "referer", lambda m: ("Referer", "P") in m["headers"]),
+        ("path", "2", lambda m: m["url"] == "http://h/user/P/edit"),
+    ],
+)
+def test_other_locations(location, parameter, check):
+    captured = request(
+        "http://h/user/12/edit",
+        headers=[("Cookie", "PHPSESSID=abc; security=low"), ("Referer", "http://h/")],
+    )
+    assert check(mutate_request(captured, parameter, "P", location))
+
+
+def test_points_skip_truncated_and_repeated_records():
+    record = {
+        "method": "GET",
+        "url": "http://h/user/1?tab=a",
+        "request_headers": [],
+        "request_body": "",
+        "request_body_encoding": "utf-8",
+    }
+    points = InjectionPoints()
+    assert [(p["location"], p["parameter"]) for p in points.feed(record)] == [
+        ("query", "tab"),
+        ("path", "2"),
+    ]
+    assert points.feed(dict(record, url="http://h/user/2?tab=b")) == []
+    truncated = dict(record, url="http://h/other?x=1", request_body_truncated=True)
+    assert points.feed(truncated) == []
@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+from snapshot import (
+    build_element_table,
+    parse_snapshot,
+    parse_viewport,
+    render_elements,
+)
+
+fixture = os.path.join(os.path.dirname(__file__), "fixtures", "login_snapshot.json")
+
+
+@pytest.fixture
+def tree():
+    with open(fixture) as f:
+        return json.load(f)
+
+
+def test_parse_snapshot(tree):
+    elements, buffer = parse_snapshot(tree, (0, 0, 1280, 1080))
+    assert elements == [
+        "<link id=0>Home</link>",
+        "<input id=1 text Username>admin</input>",
+        "<input id=2 password Password/>",
+        "<button id=3 Log in/>",
+        "<text id=4>Welcome to DVWA</text>",
+        "<button id=5>Reset</button>",
+        "<text id=6>Click me</text>",
+    ]
+    assert sorted(buffer) == list(range(7))
+
+
+def test_buffer_keeps_backend_node_ids(tree):
+    _, buffer = parse_snapshot(tree, (0, 0, 1280, 1080))
+    nodes = tree["documents"][0]["nodes"]
+    strings = tree["strings"]
+    password = buffer[2]
+    assert strings[nodes["nodeName"][password["node_index"]]] == "INPUT"
+    assert password["backend_node_id"] == nodes["backendNodeId"][password["node_index"]]
+    assert (password["center_x"], password["center_y"]) == (200, 155)
+
+
+def test_only_elements_in_viewport(tree):
+    elements, _ = parse_snapshot(tree, (0, 2500, 1280, 3580))
+    assert elements == ["<link id=0>Footer link</link>"]
+
+
+def test_device_pixel_ratio(tree):
+    # bounds are in device pixels, the viewport in CSS pixels
+    elements, buffer = parse_snapshot(tree, (0, 0, 640, 540), device_pixel_ratio=2)
+    assert len(elements) == 7
+    assert (buffer[2]["center_x"], buffer[2]["center_y"]) == (100, 77)
+
+
+def test_element_table_is_reusable(tree):
+    table = build_element_table(tree)
+    viewport = (0, 0, 1280, 1080)
+    first = render_elements(table, viewport)
+    assert render_elements(table, viewport) == first
+    assert first == parse_snapshot(tree, viewport)
+
+
+def test_parse_viewport():
+    state = {
+        "devicePixelRatio": 1.5,
+        "scrollX": 0,
+        "scrollY": 540,
+        "pageXOffset": 0,
+        "pageYOffset": 540,
+        "screenWidth": 1280,
+        "screenHeight": 1080,
+        "offsetHeight": 2160,
+        "scrollHeight": 2160,
+        "mutations": 3,
+        "timeOrigin": 1.0,
+    }
+    viewport = parse_viewport(state)
+    assert (viewport["top"], viewport["bottom"]) == (540, 1620)
+    assert viewport["scrollbar"] == "[scrollbar 25.00-75.00%]"
+    assert viewport["dom_version"] is not None
+    assert parse_viewport(dict(state, mutations=None))["dom_version"] is None